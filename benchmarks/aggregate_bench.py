@@ -0,0 +1,61 @@
+# Compares building a year's totals one activity at a time with updateContent against
+# Utils.aggregateTotals over the same synthetic history.
+#
+#   python -m benchmarks.aggregate_bench [activities ...]
+import os
+import sys
+import time
+import random
+import logging
+import datetime
+
+os.environ.setdefault("AWS_DEFAULT_REGION","eu-west-1")
+
+from src.layers.strava.src.python.strava import Strava
+from src.layers.strava.src.python.strava import Utils
+from src.layers.strava.src.python import strava as stravaModule
+
+TYPES = ["Run","Ride","Walk","Hike","Swim","Yoga","WeightTraining","Rowing"]
+
+def makeHistory(count, seed=1):
+    rng = random.Random(seed)
+    start = int(datetime.datetime(datetime.datetime.now().year,1,1,0,0).timestamp())
+    types = [rng.choice(TYPES) for i in range(count)]
+    distances = [0 if activityType in ["Yoga","WeightTraining"] else rng.uniform(500,100000) for activityType in types]
+    durations = [rng.randint(300,20000) for i in range(count)]
+    epochs = sorted(rng.randint(start,start+300*86400) for i in range(count))
+    return types, distances, durations, epochs
+
+def timeLoop(types, distances, durations):
+    # updateContent as the bulk paths used to call it, logging included (sent nowhere)
+    strava = Strava.__new__(Strava)
+    started = time.perf_counter()
+    content = {}
+    for activityType, distance, duration in zip(types,distances,durations):
+        content = strava.updateContent(content,activityType,distance,duration)
+    return time.perf_counter()-started
+
+def timeAggregate(function, types, distances, durations, epochs):
+    started = time.perf_counter()
+    function(types,distances,durations,epochs)
+    return time.perf_counter()-started
+
+def main(sizes):
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    devnull = open(os.devnull,"w")
+    root.handlers = [logging.StreamHandler(devnull)]
+    try:
+        print("{:>8} {:>12} {:>12} {:>12}".format("N","loop (s)","python (s)","numpy (s)"))
+        for size in sizes:
+            types, distances, durations, epochs = makeHistory(size)
+            loop = timeLoop(types,distances,durations)
+            plain = timeAggregate(Utils._aggregateTotalsLoop,types,distances,durations,epochs)
+            vector = timeAggregate(Utils.aggregateTotals,types,distances,durations,epochs) if stravaModule.loadNumpy() is not None else float('nan')
+            print("{:>8} {:>12.4f} {:>12.4f} {:>12.4f}".format(size,loop,plain,vector))
+    finally:
+        root.handlers = handlers
+        devnull.close()
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [100,1000,5000])
@@ -0,0 +1,180 @@
+# The layer's and the webhook's hot paths, timed fully offline against the stand-ins in
+# benchmarks/stubs.py. Results are written as JSON so runs can be compared; with
+# --compare, any benchmark whose best time got slower by more than --threshold is
+# reported and the exit code is 1. (The best of several runs is steadier than the median
+# on a busy machine.)
+#
+#   python -m benchmarks.offline_bench [--output FILE] [--compare FILE] [--latency MS]
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextlib
+import platform
+import datetime
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT,"src","webhook"),os.path.join(ROOT,"src","layers","strava","src","python")]
+os.environ.setdefault("AWS_DEFAULT_REGION","eu-west-1")
+os.environ.update({"ssmPrefix": "bench/", "totalsTable": "Totals", "detailsTable": "Details"})
+os.environ.pop("rateLimitTable",None)
+
+import strava as layer
+from strava import Strava
+from strava import Utils
+import index as webhook
+from benchmarks import stubs
+
+SIZES = [1000,5000]
+WEBHOOK_ATHLETES = 4
+WEBHOOK_RECORDS = 10
+
+class Bench(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.histories = {athleteId: stubs.makeActivities(max(SIZES) if athleteId == 1 else 200,athleteId=athleteId,seed=athleteId) for athleteId in range(1,WEBHOOK_ATHLETES+1)}
+        self.totals = stubs.FakeTable("Totals",["Id"],latency)
+        self.details = stubs.FakeTable("Details",["athleteId","activityId"],latency)
+        ssm = stubs.FakeSSM({"bench/StravaClientId": "1", "bench/StravaClientSecret": "secret", "bench/subscription_id": "1"},latency)
+        self.strava = stubs.FakeStrava(self.histories,latency)
+        self.twitter = stubs.FakeTwitter(latency)
+        layer.aws = stubs.FakeAWS({"Totals": self.totals, "Details": self.details},ssm,latency)
+        layer.http = self.strava
+        layer.parameters.invalidate()
+        layer.tokenManager.clear()
+        Strava.clearActivityCache()
+        webhook.getTwitterClient = lambda: self.twitter
+        webhook.getSpotifyTrackList = stubs.FakeSpotify(latency)
+        for athleteId, history in self.histories.items():
+            self.totals.put_item(Item=stubs.athleteItem(athleteId,Utils.aggregateTotals(
+                [activity['type'].replace("Virtual","") for activity in history],
+                [activity['distance'] for activity in history],
+                [activity['elapsed_time'] for activity in history],
+                [Utils.startEpoch(activity) for activity in history])))
+
+    def athlete(self, athleteId=1):
+        return Strava(athleteId=athleteId)
+
+def measure(function, repeat, number=1, setup=None):
+    # Seconds per call, for each of repeat runs of number calls
+    times = []
+    for run in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        for call in range(number):
+            function()
+        times.append((time.perf_counter()-started)/number)
+    return {
+        "median": statistics.median(times),
+        "min": min(times),
+        "mean": statistics.mean(times),
+        "repeat": repeat,
+        "number": number
+        }
+
+def run(bench, repeat):
+    results = {}
+    strava = bench.athlete()
+    history = bench.histories[1]
+    year = str(datetime.datetime.now().year)
+
+    def updateContent():
+        content = {}
+        for activity in history:
+            content = strava.updateContent(content,activity['type'],activity['distance'],activity['moving_time'])
+    result = measure(updateContent,repeat)
+    result.update({"median": result['median']/len(history),"min": result['min']/len(history),"mean": result['mean']/len(history),"per": "activity"})
+    results['updateContent'] = result
+
+    content = strava.getTotals()[year]
+    latest = dict(history[-1],type=history[-1]['type'].replace("Virtual",""))
+    ytd = content[latest['type']]
+    sums = [sum(totals[field] for totals in content.values()) for field in ["distance","duration","count"]]
+    results['getTags'] = measure(lambda: strava.getTags(latest,ytd,*sums),repeat,1000)
+    results['makeTwitterString'] = measure(lambda: strava.makeTwitterString(content,latest),repeat,200)
+    results['makeStravaDescriptionString'] = measure(lambda: strava.makeStravaDescriptionString(content,latest),repeat,200)
+
+    for size in SIZES:
+        # Page size is fixed by Strava, so the history is trimmed rather than the pages
+        bench.histories[1] = history[:size]
+        results['buildTotals[{}]'.format(size)] = measure(lambda: bench.athlete().buildTotals(),repeat,setup=bench.details.items.clear)
+    bench.histories[1] = history
+
+    records = []
+    for index in range(WEBHOOK_RECORDS):
+        athleteId = index % WEBHOOK_ATHLETES + 1
+        activity = bench.histories[athleteId][-(index // WEBHOOK_ATHLETES + 1)]
+        body = {"aspect_type": "create", "object_type": "activity", "object_id": activity['id'], "owner_id": athleteId, "subscription_id": 1, "event_time": int(time.time())}
+        records.append({"messageId": "m{}".format(index), "body": json.dumps(body)})
+    event = {"Records": records}
+    def batch():
+        response = webhook.lambda_handler(event,None)
+        if len(response['batchItemFailures']) > 0:
+            raise RuntimeError("Webhook batch had failures: {}".format(response))
+    results['webhook[{}]'.format(WEBHOOK_RECORDS)] = measure(batch,repeat)
+    return results
+
+def compare(results, previous, threshold):
+    regressions = []
+    print("{:<32} {:>14} {:>14} {:>8}".format("benchmark","before (ms)","after (ms)","change"))
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]['min']
+        after = result['min']
+        change = (after-before)/before if before > 0 else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<32} {:>14.4f} {:>14.4f} {:>+7.0%}{}".format(name,before*1000,after*1000,change,flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output",default=os.path.join(ROOT,"bench_results.json"))
+    parser.add_argument("--compare",default=None,help="an earlier results file to compare against")
+    parser.add_argument("--threshold",type=float,default=0.2,help="slow down (as a fraction) that counts as a regression")
+    parser.add_argument("--repeat",type=int,default=7)
+    parser.add_argument("--latency",type=float,default=0,help="milliseconds every stubbed call takes")
+    args = parser.parse_args(argv)
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    devnull = open(os.devnull,"w")
+    # The layer's logging (and metrics) are part of what it costs, so they stay on, but go nowhere
+    root.handlers = [logging.StreamHandler(devnull)]
+    try:
+        with contextlib.redirect_stdout(devnull):
+            results = run(Bench(args.latency/1000.0),args.repeat)
+    finally:
+        root.handlers = handlers
+        devnull.close()
+
+    output = {
+        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "latency_ms": args.latency,
+        "results": results
+        }
+    with open(args.output,"w") as outfile:
+        json.dump(output,outfile,indent=2)
+
+    if args.compare is None:
+        print("{:<32} {:>14} {:>14}".format("benchmark","median (ms)","min (ms)"))
+        for name, result in results.items():
+            print("{:<32} {:>14.4f} {:>14.4f}".format(name,result['median']*1000,result['min']*1000))
+    else:
+        with open(args.compare) as infile:
+            previous = json.load(infile)['results']
+        if len(compare(results,previous,args.threshold)) > 0:
+            return 1
+    print("Results written to {}".format(args.output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
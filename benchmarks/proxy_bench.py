@@ -0,0 +1,121 @@
+# Latency of the proxy, the function Strava's webhook POSTs land on and which has to
+# answer within 2 seconds. Every run is a fresh interpreter: it times the container's
+# start up (importing index), the first request and then warm requests, for each path.
+# AWS calls are answered just before they'd be sent, by a botocore event handler on the
+# real clients, so everything but the network itself is counted: client creation,
+# parameter validation, serialisation and our own code.
+#
+#   python -m benchmarks.proxy_bench [--runs N] [--warm N]
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT,"src","layers","strava","src","python")
+BUDGET = 2.0 #seconds Strava waits for a webhook response
+
+def post(body):
+    return {"rawPath": "/webhook/", "requestContext": {"http": {"method": "POST"}}, "body": json.dumps(body)}
+
+PATHS = {
+    "webhook POST (activity)": post({"object_type": "activity", "aspect_type": "create", "object_id": 1, "owner_id": 1, "subscription_id": 1}),
+    "webhook POST (other)": post({"object_type": "athlete", "aspect_type": "update", "object_id": 1, "owner_id": 1, "subscription_id": 1}),
+    "webhook GET (verify)": {"rawPath": "/webhook/", "requestContext": {"http": {"method": "GET"}}, "queryStringParameters": {"hub.challenge": "abc", "hub.verify_token": "123456789012"}},
+    "register": {"rawPath": "/register/", "requestContext": {"domainName": "example.com", "http": {"method": "GET"}}},
+}
+
+CHILD = """
+import sys, time, json
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+import boto3
+from strava import aws
+event = json.loads(sys.argv[1])
+calls = int(sys.argv[2])+1
+RESPONSES = {
+    "SendMessage": {"MessageId": "1", "MD5OfMessageBody": "x"},
+    "GetParameter": {"Parameter": {"Name": "bench/StravaClientId", "Type": "String", "Value": "1"}},
+    "GetParameters": {"Parameters": [{"Name": "bench/StravaClientId", "Type": "String", "Value": "1"}], "InvalidParameters": []}
+    }
+class Context(object):
+    invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:bench"
+class Answered(object):
+    status_code = 200
+def answer(model, **kwargs):
+    # Short circuits the call just before it would be signed and sent
+    return Answered(), dict(RESPONSES[model.name], ResponseMetadata={"HTTPStatusCode": 200, "RetryAttempts": 0})
+# Clients made from now on copy the session's handlers; ones made at import need their own
+if boto3.DEFAULT_SESSION is None:
+    boto3.setup_default_session()
+boto3.DEFAULT_SESSION.events.register("before-call.*.*", answer, unique_id="bench")
+for client in aws.clients.values():
+    client.meta.events.register("before-call.*.*", answer, unique_id="bench")
+loaded = time.perf_counter()
+index.lambda_handler(event, Context())
+first = time.perf_counter()
+warm = []
+for call in range(calls-1):
+    begun = time.perf_counter()
+    response = index.lambda_handler(event, Context())
+    warm.append(time.perf_counter()-begun)
+print(json.dumps({
+    "init": imported-started,
+    "first": first-loaded,
+    "warm": warm,
+    "status": response['statusCode']
+    }))
+"""
+
+def runOnce(event, warm):
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION","eu-west-1")
+    env.update({
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "ssmPrefix": "bench/",
+        "sqsUrl": "https://sqs.eu-west-1.amazonaws.com/123456789012/bench",
+        "PYTHONPATH": os.pathsep.join([os.path.join(ROOT,"src","proxy"),LAYER]),
+        "PYTHONDONTWRITEBYTECODE": "1"
+        })
+    env.pop("rateLimitTable",None)
+    result = subprocess.run([sys.executable,"-c",CHILD,json.dumps(event),str(warm)],env=env,capture_output=True,text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values)-1,int(round(share*(len(values)-1))))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold and warm latency of the proxy handler")
+    parser.add_argument("--runs",type=int,default=5,help="fresh interpreters per path")
+    parser.add_argument("--warm",type=int,default=200,help="warm requests per interpreter")
+    args = parser.parse_args(argv)
+
+    print("{:<24} {:>10} {:>11} {:>10} {:>10} {:>10} {:>8}".format("path","init (ms)","first (ms)","warm p50","warm p99","cold share","status"))
+    for name, event in PATHS.items():
+        results = [runOnce(event,args.warm) for run in range(args.runs)]
+        failed = [result for result in results if "error" in result]
+        if len(failed) > 0:
+            print("{:<24} unavailable: {}".format(name,failed[0]['error']))
+            continue
+        init = statistics.median(result['init'] for result in results)
+        first = statistics.median(result['first'] for result in results)
+        warm = [seconds for result in results for seconds in result['warm']]
+        print("{:<24} {:>10.1f} {:>11.2f} {:>10.3f} {:>10.3f} {:>10.1%} {:>8}".format(
+            name,
+            init*1000,
+            first*1000,
+            percentile(warm,0.5)*1000,
+            percentile(warm,0.99)*1000,
+            (init+first)/BUDGET,
+            results[0]['status']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
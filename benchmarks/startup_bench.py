@@ -0,0 +1,75 @@
+# Cold start cost of each handler: how long importing its index takes in a fresh
+# interpreter, how long the first invocation takes, and how long a warm one takes.
+# Every run is a new process so nothing is already imported or cached. The events are
+# ones that need no AWS or Strava calls (SSM lookups are answered locally), so the
+# numbers are our own start-up work rather than the network. ssmPrefix is set, as it is
+# in every deployment, so the handlers take the same paths they do in production.
+#
+#   python -m benchmarks.startup_bench [runs]
+import os
+import sys
+import json
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT,"src","layers","strava","src","python")
+
+HANDLERS = {
+    # Strava's own webhook POST for an event we don't act on; the path Strava times us on
+    "proxy": {"rawPath": "/webhook/", "requestContext": {"http": {"method": "POST"}}, "body": json.dumps({"object_type": "athlete", "aspect_type": "update"})},
+    "webhook": {"Records": []},
+    "daily": {"reset": []},
+}
+
+HEAVY = ["boto3", "requests", "numpy", "twython", "spotipy", "gspread"]
+
+CHILD = """
+import sys, time, json
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+from unittest.mock import patch
+event = json.loads(sys.argv[1])
+with patch('strava.Utils.getSSM', return_value=None):
+    index.lambda_handler(event, None)
+    first = time.perf_counter()
+    index.lambda_handler(event, None)
+    warm = time.perf_counter()
+print(json.dumps({
+    "import": imported-started,
+    "first": first-imported,
+    "warm": warm-first,
+    "loaded": [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+    }))
+"""
+
+def runOnce(handler, event):
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION","eu-west-1")
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(ROOT,"src",handler),LAYER])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    # Always set in a deployment, and it decides what the webhook sets up
+    env["ssmPrefix"] = "bench/"
+    result = subprocess.run([sys.executable,"-c",CHILD,json.dumps(event),json.dumps(HEAVY)],env=env,capture_output=True,text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main(runs=5):
+    print("{:>8} {:>12} {:>12} {:>12}  {}".format("handler","import (ms)","first (ms)","warm (ms)","heavy modules loaded"))
+    for handler, event in HANDLERS.items():
+        results = [runOnce(handler,event) for i in range(runs)]
+        failed = [result for result in results if "error" in result]
+        if len(failed) > 0:
+            print("{:>8} unavailable: {}".format(handler,failed[0]['error']))
+            continue
+        print("{:>8} {:>12.1f} {:>12.1f} {:>12.2f}  {}".format(
+            handler,
+            statistics.median(result['import'] for result in results)*1000,
+            statistics.median(result['first'] for result in results)*1000,
+            statistics.median(result['warm'] for result in results)*1000,
+            ",".join(results[0]['loaded'])))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,259 @@
+# Offline stand-ins for everything the layer and the webhook talk to: DynamoDB, SSM,
+# Strava, Twitter and Spotify. They answer from memory (after an optional fixed latency,
+# to see how well calls overlap) and keep just enough state to look like the real thing
+# to our code. They are not general purpose fakes.
+import re
+import json
+import time
+import random
+import bisect
+import datetime
+import threading
+
+TYPES = ["Run","Ride","Walk","Hike","Swim","Yoga","WeightTraining","VirtualRide"]
+
+def makeActivities(count, athleteId=1, year=None, seed=1):
+    # A season's worth of synthetic Strava activities, in start order
+    rng = random.Random(seed)
+    if year is None:
+        year = datetime.datetime.now().year
+    start = int(datetime.datetime(year,1,1,0,0).timestamp())
+    activities = []
+    for index, epoch in enumerate(sorted(rng.randint(start,start+300*86400) for i in range(count))):
+        activityType = rng.choice(TYPES)
+        duration = rng.randint(300,20000)
+        activity = {
+            "id": athleteId*10000000+index+1,
+            "athlete": {"id": athleteId},
+            "name": "Activity {}".format(index+1),
+            "type": activityType,
+            "distance": 0.0 if activityType in ["Yoga","WeightTraining"] else round(rng.uniform(500,100000),1),
+            "moving_time": duration,
+            "elapsed_time": duration+rng.randint(0,600),
+            "start_date": datetime.datetime.utcfromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "start_date_local": datetime.datetime.utcfromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "achievement_count": rng.choice([0,0,0,1,3]),
+            "pr_count": rng.choice([0,0,1]),
+            "average_heartrate": rng.choice([None,120.5,150.2]),
+            "resource_state": 3,
+            "private": False,
+            "photos": {"primary": {"urls": {"600": "https://photos.example/{}.jpg".format(index)}}} if index % 3 == 0 else {"primary": None}
+            }
+        if activity['average_heartrate'] is None:
+            del activity['average_heartrate']
+        activities.append(activity)
+    return activities
+
+def pause(latency):
+    if latency > 0:
+        time.sleep(latency)
+
+class FakeTable(object):
+    # A DynamoDB Table handle. Items are kept per key; updates are not evaluated, they just
+    # hand back the item as it stands (the totals item, for addToTotals).
+    def __init__(self, name, keyNames, latency=0):
+        self.name = name
+        self.keyNames = keyNames
+        self.latency = latency
+        self.items = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        return tuple(str(key[name]) for name in self.keyNames)
+
+    def get_item(self, Key, **kwargs):
+        pause(self.latency)
+        with self.lock:
+            self.calls+=1
+            item = self.items.get(self._key(Key))
+        if item is None:
+            return {}
+        return {"Item": dict(item)}
+
+    def put_item(self, Item, **kwargs):
+        pause(self.latency)
+        with self.lock:
+            self.calls+=1
+            self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def update_item(self, Key, **kwargs):
+        pause(self.latency)
+        with self.lock:
+            self.calls+=1
+            item = self.items.setdefault(self._key(Key),dict(Key))
+        if kwargs.get('ReturnValues') == "ALL_NEW":
+            return {"Attributes": dict(item)}
+        return {}
+
+    def query(self, **kwargs):
+        pause(self.latency)
+        return {"Items": []}
+
+class FakeDynamoDB(object):
+    # The DynamoDB resource, for the batch calls
+    def __init__(self, tables, latency=0):
+        self.tables = tables
+        self.latency = latency
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        pause(self.latency)
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            responses[name] = [table.items[table._key(key)] for key in request['Keys'] if table._key(key) in table.items]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        pause(self.latency)
+        for name, requests in RequestItems.items():
+            for request in requests:
+                self.tables[name].put_item(Item=request['PutRequest']['Item'])
+        return {"UnprocessedItems": {}}
+
+class FakeSSM(object):
+    def __init__(self, values, latency=0):
+        self.values = values
+        self.latency = latency
+
+    def get_parameters(self, Names):
+        pause(self.latency)
+        return {
+            "Parameters": [{"Name": name, "Value": self.values[name]} for name in Names if name in self.values],
+            "InvalidParameters": [name for name in Names if name not in self.values]
+            }
+
+    def get_parameter(self, Name):
+        pause(self.latency)
+        return {"Parameter": {"Name": Name, "Value": self.values[Name]}}
+
+class FakeAWS(object):
+    # Stands in for the layer's AWSRegistry
+    def __init__(self, tables, ssm, latency=0):
+        self.tables = tables
+        self.dynamodb = FakeDynamoDB(tables, latency)
+        self.ssm = ssm
+
+    def client(self, serviceName):
+        if serviceName == "ssm":
+            return self.ssm
+        raise NotImplementedError(serviceName)
+
+    def resource(self, serviceName):
+        return self.dynamodb
+
+    def table(self, tableName):
+        return self.tables[tableName]
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, content=b""):
+        self.status_code = status_code
+        self.body = body
+        self.content = content
+        self.text = json.dumps(body) if body is not None else ""
+        self.headers = {"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "1,1"}
+
+    def json(self):
+        return self.body
+
+class FakeStrava(object):
+    # The shared HTTP session, answering for Strava's API (and the photo CDN) from
+    # synthetic histories, one per athlete
+    ACTIVITIES = re.compile(r"/activities\?after=([\d.]+)&page=(\d+)&per_page=(\d+)")
+    ACTIVITY = re.compile(r"/activities/(\d+)$")
+
+    def __init__(self, histories, latency=0):
+        self.histories = histories
+        self.epochs = {}
+        self.byId = {activity['id']: activity for history in histories.values() for activity in history}
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _count(self):
+        with self.lock:
+            self.calls+=1
+
+    def _athlete(self, headers):
+        return int(headers['Authorization'].split("-")[-1])
+
+    def _epochs(self, history):
+        # Start epochs of a (sorted) history, worked out once rather than on every page
+        key = (id(history),len(history))
+        if key not in self.epochs:
+            self.epochs[key] = [int(datetime.datetime.strptime(activity['start_date'],"%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()) for activity in history]
+        return self.epochs[key]
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        pause(self.latency)
+        self._count()
+        if url.startswith("https://photos.example/"):
+            return FakeResponse(200, content=b"\xff\xd8" + b"\x00"*60000)
+        match = self.ACTIVITIES.search(url)
+        if match:
+            after, page, perPage = [int(float(value)) for value in match.groups()]
+            history = self.histories[self._athlete(headers)]
+            first = bisect.bisect_right(self._epochs(history),after)
+            return FakeResponse(200, history[first+(page-1)*perPage:first+page*perPage])
+        match = self.ACTIVITY.search(url)
+        if match:
+            return FakeResponse(200, dict(self.byId[int(match.group(1))]))
+        if url.endswith("/athlete"):
+            athleteId = self._athlete(headers)
+            return FakeResponse(200, {"id": athleteId, "firstname": "Bench", "lastname": "Athlete{}".format(athleteId)})
+        return FakeResponse(404, {"message": "Not Found"})
+
+    def put(self, url, headers=None, data=None, timeout=None, **kwargs):
+        pause(self.latency)
+        self._count()
+        return FakeResponse(200, {"id": 1})
+
+    def post(self, url, json=None, timeout=None, **kwargs):
+        pause(self.latency)
+        self._count()
+        return FakeResponse(200, {"expires_at": int(time.time())+21600, "access_token": "token", "refresh_token": "refresh"})
+
+class FakeTwitter(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.statuses = []
+        self.lock = threading.Lock()
+
+    def upload_media(self, media):
+        pause(self.latency)
+        return {"media_id": 1}
+
+    def update_status(self, status, media_ids=None):
+        pause(self.latency)
+        with self.lock:
+            self.statuses.append(status)
+        return {"id": 1}
+
+class FakeSpotify(object):
+    # Replaces the webhook's getSpotifyTrackList
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def __call__(self, tokens, start_date):
+        pause(self.latency)
+        return "I listened to the following tracks:\n* Bench - Mark\n"
+
+def athleteItem(athleteId, totals=None):
+    # A totals table item with tokens that won't need refreshing. Access tokens end in the
+    # athlete id, so FakeStrava can tell who's asking.
+    from strava import Utils
+    item = {
+        "Id": str(athleteId),
+        "tokens": json.dumps({"expires_at": int(time.time())+86400, "access_token": "token-{}".format(athleteId), "refresh_token": "refresh"}),
+        "spotify": json.dumps({"client_id": "id", "client_secret": "secret"}),
+        "profile": json.dumps({"id": athleteId, "firstname": "Bench", "lastname": "Athlete{}".format(athleteId)}),
+        "profileFetched": int(time.time())
+        }
+    if totals is not None:
+        item.update(Utils.totalsToAttributes(totals))
+        item['totals_years'] = set(totals.keys())
+    return item
@@ -4,26 +4,37 @@ import json
 from datetime import datetime
 import time
 import os
-import requests
-import boto3
 import logging
-import hashlib
-import math
-from io import BytesIO
-from botocore.exceptions import ClientError
 from strava import Strava
 from strava import Utils
-import gspread
+from strava import RateLimitDeferred
+from strava import metrics
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 debug = False
 
+RESET_WORKERS = 4 # Athletes reset in parallel; override with the resetWorkers environment variable or 'workers' in the event
+RESET_TIME_MARGIN = 60000 #milliseconds of Lambda time we keep back rather than starting another athlete
+RESET_TOKEN_MARGIN = 900 #seconds of life tokens need at the start of a reset, so none expire mid-run (the function times out at 600)
+PROFILE_WORKERS = 4 # Athlete profiles refreshed in parallel; override with the profileWorkers environment variable
+Utils.declareWorkers(resetWorkers=RESET_WORKERS,profileWorkers=PROFILE_WORKERS)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 def lambda_handler(event, context):
+    try:
+        return handleEvent(event, context)
+    finally:
+        Utils.flushMetrics("daily")
+
+def handleEvent(event, context):
 
     logging.info("Underpants")
-    logging.info(event)
+    Utils.resetLogBudget()
+    Utils.logPayload("Event",event)
     
     year = str(datetime.now().year)
     month = datetime.now().month
@@ -42,20 +53,33 @@ def lambda_handler(event, context):
             AthleteIds = getIds()
         else:
             AthleteIds = event['reset']
-            
-        logger.info("Resetting {}".format(AthleteIds))
-        count=0
-        for athleteId in AthleteIds:
-            logger.info("Processing {}".format(athleteId))
-            strava = Strava(athleteId=athleteId,stravaClientId=stravaClientId,stravaClientSecret=stravaClientSecret)
-            strava.flattenTotals()
-            strava.buildTotals()
-            count+=1
-            logger.info("Done {COUNT}. {REMAIN} to go".format(COUNT=count, REMAIN=len(AthleteIds)-count))
-            logger.info(AthleteIds[count:])
+        
+        # Every invocation is a new run, so a re-run (after a failure, say) resets everyone again.
+        # Lambda's own retries of an event keep its request id, and so resume the same run, as
+        # does passing back the resetRun a stopped run returned.
+        resetRun = str(event.get('resetRun', newResetRun(context)))
+        workers = int(event.get('workers', Utils.getEnvInt('resetWorkers',RESET_WORKERS)))
+        logger.info("Resetting {IDS} as run {RUN}".format(IDS=AthleteIds,RUN=resetRun))
+        result = resetAthletes(AthleteIds,resetRun,workers,stravaClientId,stravaClientSecret,context,event.get('source','strava'))
+        result['resetRun'] = resetRun
+        logger.info("Done {DONE}, skipped {SKIPPED} (already reset or unknown). Still to do: {REMAINING}".format(DONE=len(result['done']),SKIPPED=len(result['skipped']),REMAINING=result['remaining']))
+        logging.info("Profit!")
+        return result
+    elif 'refreshProfiles' in event:
+        
+        if event['refreshProfiles'] == 'ALL':
+            AthleteIds = getIds()
+        else:
+            AthleteIds = event['refreshProfiles']
+        
+        result = refreshProfiles(AthleteIds,Utils.getEnvInt('profileWorkers',PROFILE_WORKERS),stravaClientId,stravaClientSecret,event.get('force',False))
+        logger.info("Refreshed {REFRESHED} profiles, {FAILED} failed".format(REFRESHED=len(result['refreshed']),FAILED=len(result['failed'])))
+        logging.info("Profit!")
+        return result
     else:
         
-        # Get some google connectivity
+        # Get some google connectivity; only the sheet sync needs gspread, so it's imported here
+        import gspread
         googleCredentials = json.loads(Utils.getSSM("GooglePermissions"))
         gc = gspread.service_account_from_dict(googleCredentials)
         
@@ -66,66 +90,183 @@ def lambda_handler(event, context):
         # Open the worksheet in the spreadsheet
         worksheet = sheet.worksheet("{SHEETPREFIX} {YEAR}".format(SHEETPREFIX=googleSheetName.split(".")[1],YEAR=year))
         
-        # List all the athlete Ids that are currently in the sheet
-        listOfIds =  worksheet.col_values(1)
-        listOfNames = worksheet.col_values(2)
-        
         # List all the athletes that we currently know about
         AthleteIds = getIds()
         
-        for Id in AthleteIds:
-            runningYTD=0.0
-            logger.info("Working on {}".format(Id))
-            
-            strava = Strava(athleteId=Id,stravaClientId=stravaClientId,stravaClientSecret=stravaClientSecret)
-            
-            athlete_record = strava._getAthleteFromDDB()
-            if "body" not in athlete_record:
-                logger.info("No running so far")
-                continue
-            body=json.loads(athlete_record['body'])
-            logger.info(body)
+        syncSheet(worksheet,AthleteIds,year,month,stravaClientId,stravaClientSecret)
+
+    logging.info("Profit!")
+
+def syncSheet(worksheet, AthleteIds, year, month, stravaClientId, stravaClientSecret):
+    # Read the worksheet once, work out every cell that needs to change, then write them all
+    # back with one batch_update and add any new athletes with one insert. That keeps us to a
+    # handful of Sheets API calls however big the club gets.
+    with metrics.span("GoogleSheets","get_all_values"):
+        rows = worksheet.get_all_values()
+    rowsById = {}
+    rowsByName = {}
+    lastNameRow = 0
+    for index, row in enumerate(rows):
+        if len(row) > 0 and row[0] != "":
+            rowsById[str(row[0])] = index+1
+        if len(row) > 1 and row[1] != "":
+            rowsByName[row[1]] = index+1
+            lastNameRow = index+1
     
-            if Id in listOfIds:
-                logger.info("Found existing athlete")
-                if year in body:
-                    logger.info("Updating YTD for runnner {}".format(Id))
-                    runningYTD = calculateYTDmiles(body[year])
-                else:
-                    logger.info("Runner {} has not run this year so far.".format(Id))
-                cell = worksheet.find(Id, in_column=1)
-                worksheet.update_cell(cell.row,month+2 , runningYTD)
+    cells = {}
+    newRows = []
+    for Id in AthleteIds:
+        runningYTD=0.0
+        logger.info("Working on {}".format(Id))
+        
+        strava = Strava(athleteId=Id,stravaClientId=stravaClientId,stravaClientSecret=stravaClientSecret)
+        
+        if strava.athlete is None:
+            logger.info("No athlete {} registered".format(Id))
+            continue
+        # Registered athletes with nothing logged yet still get their row, with a 0
+        body = strava.getTotals()
+        
+        if year in body:
+            logger.info("Updating YTD for runnner {}".format(Id))
+            runningYTD = calculateYTDmiles(body[year])
+        else:
+            logger.info("Runner {} has not run this year so far.".format(Id))
+        
+        if Id in rowsById:
+            logger.info("Found existing athlete")
+            cells[(rowsById[Id],month+2)] = runningYTD
+            continue
+        
+        logger.info("New athlete")
+        strava_athlete = strava.getProfile()
+        fullName="{FIRSTNAME} {LASTNAME}".format(FIRSTNAME=strava_athlete['firstname'],LASTNAME=strava_athlete['lastname'])
+        if fullName in rowsByName:
+            cells[(rowsByName[fullName],1)] = Id
+            cells[(rowsByName[fullName],month+2)] = runningYTD
+            rowsById[Id] = rowsByName[fullName]
+        else:
+            newRow=[Id,fullName]
+            if year in body:
+                logger.info("Adding YTD for runnner {}".format(Id))
+                newRow.extend([0] * (month-1))
+                newRow.append(runningYTD)
             else:
-                logger.info("New athlete")
-                strava_athlete = strava.getCurrentAthlete()
-                fullName="{FIRSTNAME} {LASTNAME}".format(FIRSTNAME=strava_athlete['firstname'],LASTNAME=strava_athlete['lastname'])
-                if fullName in listOfNames:
-                    cell = worksheet.find(fullName, in_column=2)
-                    worksheet.update_cell(cell.row,1, Id)
-                    if year in body:
-                        logger.info("Updating YTD for runnner {}".format(Id))
-                        runningYTD = calculateYTDmiles(body[year])
-                    else:
-                        logger.info("Runner {} has not run this year so far.".format(Id))
-                    worksheet.update_cell(cell.row,month+2 , runningYTD)
-                else:
-                    newRow=[Id,fullName]
-                    if year in body:
-                        logger.info("Adding YTD for runnner {}".format(Id))
-                        runningYTD = calculateYTDmiles(body[year])
-                        nonMonths=[0] * (month-1)
-                        newRow.extend(nonMonths)
-                        newRow.append(runningYTD)
-                    else:
-                        logger.info("Athlete {} is new, but has not done any running this year.".format(Id))
-                        strava_athlete = strava.getCurrentAthlete()
-                        newRow=[Id,"{FIRSTNAME} {LASTNAME}".format(FIRSTNAME=strava_athlete['firstname'],LASTNAME=strava_athlete['lastname'])]
-                        nonMonths=[0] * (month)
-                        newRow.extend(nonMonths)
-                    worksheet.insert_row(newRow,index=len(listOfNames)+1)
-                listOfNames.append(fullName)
+                logger.info("Athlete {} is new, but has not done any running this year.".format(Id))
+                newRow.extend([0] * (month))
+            newRows.append(newRow)
+    
+    updates = []
+    for (row, col), value in sorted(cells.items()):
+        if row <= len(rows) and col <= len(rows[row-1]) and sameCell(rows[row-1][col-1],value):
+            continue
+        updates.append({"range": cellName(row,col), "values": [[value]]})
+    logger.info("Updating {UPDATES} cells and adding {NEW} athletes".format(UPDATES=len(updates),NEW=len(newRows)))
+    if len(updates) > 0:
+        with metrics.span("GoogleSheets","batch_update"):
+            worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+    if len(newRows) > 0:
+        # After the updates, as inserting shifts the rows below
+        with metrics.span("GoogleSheets","insert_rows"):
+            worksheet.insert_rows(newRows, row=lastNameRow+1, value_input_option='USER_ENTERED')
+    return {"updated": len(updates), "added": len(newRows)}
 
-    logging.info("Profit!")
+def cellName(row, col):
+    # A1 notation, eg. (3,28) is AB3
+    letters = ""
+    while col > 0:
+        col, remainder = divmod(col-1,26)
+        letters = chr(ord("A")+remainder)+letters
+    return "{LETTERS}{ROW}".format(LETTERS=letters,ROW=row)
+
+def sameCell(existing, value):
+    if str(existing) == str(value):
+        return True
+    try:
+        return abs(float(existing)-float(value)) < 0.000001
+    except ValueError:
+        return False
+
+def newResetRun(context=None):
+    if context is not None and hasattr(context,"aws_request_id"):
+        return str(context.aws_request_id)
+    # Run locally, with no request id to go on
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+def resetAthletes(AthleteIds, resetRun, workers, stravaClientId, stravaClientSecret, context=None, source="strava"):
+    # Rebuild each athlete's totals on a pool of workers. Each finished athlete is stamped with
+    # the run id, which is the checkpoint; we stop starting new athletes when the Lambda is
+    # nearly out of time or Strava's budget needs to go to live traffic. With source 'details' the
+    # totals are recomputed from the details table, and Strava is only asked for newer activities.
+    stop = threading.Event()
+    
+    def resetOne(athleteId):
+        if stop.is_set():
+            return "remaining"
+        if context is not None and context.get_remaining_time_in_millis() < RESET_TIME_MARGIN:
+            logger.info("Running out of time; leaving {} for the next run".format(athleteId))
+            stop.set()
+            return "remaining"
+        started = time.time()
+        try:
+            strava = Strava(athleteId=athleteId,stravaClientId=stravaClientId,stravaClientSecret=stravaClientSecret)
+            if strava.athlete is None:
+                logger.error("No athlete {} to reset".format(athleteId))
+                return "skipped"
+            if strava.athlete.get('last_reset_run') == resetRun:
+                logger.info("{ID} already reset in run {RUN}".format(ID=athleteId,RUN=resetRun))
+                return "skipped"
+            # Tokens that will outlast the reset, so the build never stops to refresh them
+            strava.refreshTokens(RESET_TOKEN_MARGIN)
+            # Both replace the year's totals in one write, so there's nothing to flatten first
+            if source == "details":
+                strava.recomputeTotals()
+            else:
+                strava.buildTotals()
+            strava.markReset(resetRun)
+        except RateLimitDeferred as e:
+            # Leave the rest of Strava's budget for live webhook traffic
+            logger.error(e)
+            stop.set()
+            return "remaining"
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.error("Failed to reset {}".format(athleteId))
+            return "remaining"
+        logger.info("Reset {ID} in {SECS:0.1f}s".format(ID=athleteId,SECS=time.time()-started))
+        return "done"
+    
+    result = {"done": [], "skipped": [], "remaining": []}
+    with ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+        for athleteId, outcome in zip(AthleteIds, pool.map(resetOne, AthleteIds)):
+            result[outcome].append(athleteId)
+    return result
+    
+def refreshProfiles(AthleteIds, workers, stravaClientId, stravaClientSecret, force=False):
+    # Keep the profiles cached on the totals items fresh, so the webhook and the sheet
+    # sync never need to ask Strava who an athlete is. Only stale profiles are fetched,
+    # unless forced.
+    def refreshOne(athleteId):
+        try:
+            strava = Strava(athleteId=athleteId,stravaClientId=stravaClientId,stravaClientSecret=stravaClientSecret)
+            if strava.athlete is None:
+                return "failed"
+            if force:
+                profile = strava.refreshProfile()
+            else:
+                profile = strava.getProfile()
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            return "failed"
+        if len(profile) == 0:
+            return "failed"
+        return "refreshed"
+    
+    result = {"refreshed": [], "failed": []}
+    with ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+        for athleteId, outcome in zip(AthleteIds, pool.map(refreshOne, AthleteIds)):
+            result[outcome].append(athleteId)
+    return result
     
 def calculateYTDmiles(body):
     walk = 0
@@ -146,11 +287,5 @@ def calculateYTDmiles(body):
         
     return ytd
 
-def getIds():
-    ddb = boto3.resource('dynamodb')
-    ddbTable = ddb.Table(Utils.getEnv('totalsTable'))
-    Ids = ddbTable.scan(ProjectionExpression='Id')
-    returnable = []
-    for Id in Ids['Items']:
-        returnable.append(Id['Id'])
-    return returnable
\ No newline at end of file
+def getIds(activeInYear=None):
+    return list(Utils.iterAthleteIds(activeInYear=activeInYear))
\ No newline at end of file
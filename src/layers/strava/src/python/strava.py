@@ -1,14 +1,19 @@
 import json
 import time
 import logging
-import requests
 import boto3
+from botocore.exceptions import ClientError
 import datetime
 import math
 import os
-import traceback
 import random
 import sys
+import threading
+import collections
+import copy
+import decimal
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger()
 
@@ -18,8 +23,751 @@ logger.setLevel(logging.INFO)
 
 PAUSE = 1 #second
 RETRIES = 5
+SSM_CACHE_TTL = 300 #seconds; override with the ssmCacheTTL environment variable
+HTTP_TIMEOUT = (3.05, 10) #seconds; (connect, read) for every call to Strava
+HTTP_POOL_SIZE = 10 # Minimum keep-alive connections per host; raised to fit the worker settings, or set with the httpPoolSize environment variable
+ACTIVITY_CACHE_SIZE = 64
+ACTIVITY_MAX_AGE = 300 #seconds a cached activity is trusted before we ask Strava again
+BACKFILL_WORKERS = 4 # Pages fetched in parallel by buildTotals; override with the backfillWorkers environment variable
+RATE_LIMIT_RESERVE = 0.2 # Share of each Strava rate limit window that deferrable work leaves for live webhook traffic
+RATE_LIMIT_MAX_WAIT = 120 #seconds deferrable work will wait for the next window before giving up
+RATE_STORE_INTERVAL = 5 #seconds between syncs of our view of the rate limit with the shared store
+TOTALS_PREFIX = "totals:"
+SCAN_SEGMENTS = 4 # Parallel scan segments when listing athletes; override with the scanSegments environment variable
+PROFILE_MAX_AGE = 7*24*60*60 #seconds a cached athlete profile is used before we ask Strava again; override with the profileMaxAge environment variable
+AWS_POOL_SIZE = 10 # Minimum connections per AWS client; raised to fit the worker settings, or set with the awsPoolSize environment variable
+WORKER_SETTINGS = ["webhookWorkers","ioWorkers","fetchWorkers","resetWorkers","profileWorkers","backfillWorkers","scanSegments"]
+TOKEN_REFRESH_MARGIN = 300 #seconds before expires_at that tokens are refreshed; override with the tokenRefreshMargin environment variable
+TOKEN_LEASE = 30 #seconds one caller holds the right to refresh an athlete's tokens
+CLAIM_LEASE = 1200 #seconds a claimed webhook activity is held before another delivery may take it over; at least the webhook Timeout plus the queue VisibilityTimeout in template.yml, so a batch still running is never taken over by its redelivery; override with the claimLease environment variable
+LOG_BYTE_BUDGET = 64*1024 # Bytes of payload dumps (events, totals, API responses) logged per invocation; override with the logByteBudget environment variable
+LOG_PAYLOAD_MAX = 4096 # Payloads bigger than this are cut down to it, bar a sample; override with the logPayloadMax environment variable
+LOG_SAMPLE_PERCENT = 5 # Share of big payloads logged whole; override with the logSamplePercent environment variable
 
-ssm = boto3.client("ssm")
+# Clients and heavy modules are made on first use rather than at import, so a cold start
+# only pays for what the invocation actually needs
+requests = None
+numpy = None
+numpyLoaded = False
+
+class ParameterCache(object):
+    # Every parameter any of the functions reads. They are fetched together with one
+    # batched GetParameters call and then served from memory for the life of the
+    # (warm) container, until the TTL runs out or invalidate() is called.
+    KNOWN_PARAMETERS = [
+        "StravaClientId",
+        "StravaClientSecret",
+        "StravaClubId",
+        "subscription_id",
+        "TwitterConsumerKey",
+        "TwitterConsumerSecret",
+        "TwitterAccessTokenKey",
+        "TwitterAccessTokenSecret",
+        "GooglePermissions",
+        "GoogleSheetName"
+        ]
+    GET_PARAMETERS_LIMIT = 10 # Max names per GetParameters call
+    
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+        self.loadedAt = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+    
+    def getTTL(self):
+        if self.ttl is not None:
+            return self.ttl
+        return Utils.getEnvInt('ssmCacheTTL',SSM_CACHE_TTL)
+    
+    def isExpired(self):
+        return self.loadedAt is None or time.time() - self.loadedAt > self.getTTL()
+    
+    def get(self, parameterName):
+        with self.lock:
+            if self.isExpired():
+                self.misses+=1
+                self._load()
+                if parameterName in self.values:
+                    return self.values[parameterName]
+            elif parameterName in self.values:
+                self.hits+=1
+                return self.values[parameterName]
+            else:
+                self.misses+=1
+            # Not one of the batched names, so fetch it on its own and remember it
+            self.values[parameterName] = self._getOne(parameterName)
+            return self.values[parameterName]
+    
+    def invalidate(self, parameterName=None):
+        with self.lock:
+            if parameterName is None:
+                self.values = {}
+                self.loadedAt = None
+            else:
+                self.values.pop(parameterName,None)
+    
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,"loads":self.loads,"size":len(self.values)}
+    
+    def _load(self):
+        prefix = Utils.getEnv('ssmPrefix')
+        if prefix is None:
+            prefix = ""
+        # Refresh anything else we've been asked for too, so it doesn't go stale
+        names = list(self.KNOWN_PARAMETERS)
+        for parameterName in self.values:
+            if parameterName not in names:
+                names.append(parameterName)
+        values = {}
+        logger.info("Loading {COUNT} parameters from parameter store".format(COUNT=len(names)))
+        try:
+            for index in range(0,len(names),self.GET_PARAMETERS_LIMIT):
+                fullNames = ["{PREFIX}{PARAMNAME}".format(PREFIX=prefix,PARAMNAME=name) for name in names[index:index+self.GET_PARAMETERS_LIMIT]]
+                response = getSSMClient().get_parameters(Names=fullNames)
+                for parameter in response['Parameters']:
+                    values[parameter['Name'][len(prefix):]] = parameter['Value']
+                for invalid in response['InvalidParameters']:
+                    values[invalid[len(prefix):]] = None
+        except Exception as e:
+            logger.error(e)
+            logger.error("Failed to batch load parameters; falling back to single lookups")
+            values = {}
+        self.values = values
+        self.loadedAt = time.time()
+        self.loads+=1
+    
+    def _getOne(self, parameterName):
+        parameterFullName="{PREFIX}{PARAMNAME}".format(PREFIX=Utils.getEnv('ssmPrefix'),PARAMNAME=parameterName)
+        logger.info("Getting {PARAM} from parameter store".format(PARAM=parameterName))
+        try:
+            return getSSMClient().get_parameter(Name=parameterFullName)['Parameter']['Value']
+        except Exception as e:
+            logger.error(e)
+            logger.error("No {PARAM} set in SSM parameter store".format(PARAM=parameterFullName))
+            return None
+
+parameters = ParameterCache()
+
+http = None
+http_lock = threading.Lock()
+worker_defaults = {}
+
+class Span(object):
+    # Times one outbound call; set status (and retries) on it before it ends
+    def __init__(self, metrics, dependency, operation):
+        self.metrics = metrics
+        self.dependency = dependency
+        self.operation = operation
+        self.status = "ok"
+        self.retries = 0
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, excType, exc, tb):
+        if excType is not None and self.status == "ok":
+            self.status = excType.__name__
+        self.metrics.record(self.dependency,self.operation,time.perf_counter()-self.started,self.status,self.retries)
+        return False
+
+class Metrics(object):
+    # Latency, outcome and retries of every call we make to something else (Strava, DynamoDB,
+    # SSM, Twitter, Spotify...), added up in memory and written once per invocation by flush()
+    # as CloudWatch Embedded Metric Format: one JSON line per dependency and operation on
+    # stdout, which CloudWatch Logs turns into metrics without any extra API calls.
+    NAMESPACE = "StravaToTwitter"
+    MAX_VALUES = 100 # EMF takes at most 100 values per metric; calls beyond that still count
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+    
+    def span(self, dependency, operation):
+        return Span(self, dependency, operation)
+    
+    def record(self, dependency, operation, seconds, status="ok", retries=0):
+        failed = status != "ok" and not (isinstance(status, int) and status < 400)
+        with self.lock:
+            calls = self.calls.setdefault((dependency, operation), {"count": 0, "errors": 0, "retries": 0, "latencies": [], "statuses": collections.Counter()})
+            calls['count']+=1
+            calls['retries']+=retries
+            if failed:
+                calls['errors']+=1
+            if len(calls['latencies']) < self.MAX_VALUES:
+                calls['latencies'].append(round(seconds*1000,3))
+            calls['statuses'][str(status)]+=1
+    
+    def instrument(self, client):
+        # Every API call a boto3 client makes gets a span, via botocore's own events
+        dependency = client.meta.service_model.service_id
+        def before(context, **kwargs):
+            context['metricsStarted'] = time.perf_counter()
+        def after(context, model, http_response, parsed, **kwargs):
+            if 'metricsStarted' in context:
+                self.record(dependency,model.name,time.perf_counter()-context['metricsStarted'],http_response.status_code,parsed.get('ResponseMetadata',{}).get('RetryAttempts',0))
+        def error(context, model, exception, **kwargs):
+            if 'metricsStarted' in context:
+                self.record(dependency,model.name,time.perf_counter()-context['metricsStarted'],type(exception).__name__)
+        client.meta.events.register_first('before-call.*.*',before)
+        client.meta.events.register('after-call.*.*',after)
+        client.meta.events.register('after-call-error.*.*',error)
+        return client
+    
+    def flush(self, function):
+        # Writes out (and forgets) everything recorded since the last flush
+        with self.lock:
+            calls = self.calls
+            self.calls = {}
+        timestamp = int(time.time()*1000)
+        documents = []
+        for (dependency, operation), recorded in sorted(calls.items()):
+            documents.append({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.NAMESPACE,
+                        "Dimensions": [["Function","Dependency","Operation"],["Function","Dependency"]],
+                        "Metrics": [
+                            {"Name": "Latency", "Unit": "Milliseconds"},
+                            {"Name": "Calls", "Unit": "Count"},
+                            {"Name": "Errors", "Unit": "Count"},
+                            {"Name": "Retries", "Unit": "Count"}
+                            ]
+                        }]
+                    },
+                "Function": function,
+                "Dependency": dependency,
+                "Operation": operation,
+                "Latency": recorded['latencies'],
+                "Calls": recorded['count'],
+                "Errors": recorded['errors'],
+                "Retries": recorded['retries'],
+                "Statuses": dict(recorded['statuses'])
+                })
+        for document in documents:
+            # Straight to stdout, so log levels and formats can't get in the way
+            print(json.dumps(document))
+        return documents
+
+metrics = Metrics()
+
+class LazyPayload(object):
+    # A payload as a logging argument: it's only serialised (and charged to the budget) if
+    # a handler actually emits the record, and only once however many handlers do
+    def __init__(self, log, label, payload):
+        self.log = log
+        self.label = label
+        self.payload = payload
+        self.size = None
+        self.text = None
+    
+    def __str__(self):
+        if self.text is None:
+            if isinstance(self.payload, str):
+                text = self.payload
+            else:
+                text = json.dumps(self.payload, default=str)
+            self.size = len(text)
+            self.text = self.log.charge(self.label, text)
+        return self.text
+
+class PayloadLog(object):
+    # Dumps of whole payloads are what make our logs big: a full SQS event, the totals for
+    # every activity of a reset, each page from Strava. They go through here, at DEBUG unless
+    # the logPayloads environment variable is INFO, and each invocation gets a byte budget for
+    # them; past LOG_PAYLOAD_MAX they're truncated unless sampled, and once the budget is
+    # spent only their size is logged. Call reset() at the start of each invocation.
+    def __init__(self, budget=None, maxSize=None, samplePercent=None):
+        self.lock = threading.Lock()
+        self.budget = budget
+        self.maxSize = maxSize
+        self.samplePercent = samplePercent
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.used = 0
+            self.skipped = 0
+            self.warned = False
+    
+    def level(self):
+        if os.environ.get('logPayloads','').upper() == "INFO":
+            return logging.INFO
+        return logging.DEBUG
+    
+    def log(self, label, payload, level=None):
+        if level is None:
+            level = self.level()
+        if logger.isEnabledFor(level):
+            logger.log(level, "%s: %s", label, LazyPayload(self, label, payload))
+    
+    def charge(self, label, text):
+        budget = self.budget if self.budget is not None else Utils.getEnvInt('logByteBudget',LOG_BYTE_BUDGET)
+        maxSize = self.maxSize if self.maxSize is not None else Utils.getEnvInt('logPayloadMax',LOG_PAYLOAD_MAX)
+        if len(text) > maxSize:
+            samplePercent = self.samplePercent if self.samplePercent is not None else Utils.getEnvInt('logSamplePercent',LOG_SAMPLE_PERCENT)
+            if random.random()*100 >= samplePercent:
+                text = "{HEAD}... ({MORE} more bytes)".format(HEAD=text[:maxSize],MORE=len(text)-maxSize)
+        with self.lock:
+            if self.used+len(text) > budget:
+                self.skipped+=1
+                warn = not self.warned
+                self.warned = True
+                text = "({SIZE} bytes not logged)".format(SIZE=len(text))
+            else:
+                self.used+=len(text)
+                warn = False
+        if warn:
+            logger.warning("Payload log budget of {BUDGET} bytes spent at '{LABEL}'; only sizes are logged from here".format(BUDGET=budget,LABEL=label))
+        return text
+
+payloads = PayloadLog()
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per record, for the logFormat=json environment variable. The message
+    # is still only built here, when the record is emitted.
+    def format(self, record):
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage()
+            }
+        args = record.args if isinstance(record.args, tuple) else ()
+        for arg in args:
+            if isinstance(arg, LazyPayload):
+                document['payload'] = arg.label
+                document['payloadBytes'] = arg.size
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+if os.environ.get('logFormat','').lower() == "json":
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JSONFormatter())
+
+class AWSRegistry(object):
+    # One of each boto3 client, resource and table handle for the whole container, shared by
+    # every Strava instance and thread, so the daily run doesn't build (and connect) a new
+    # DynamoDB resource per athlete. Each gets a connection pool big enough for the most
+    # threads we'll run at once.
+    def __init__(self, poolSize=None):
+        self.lock = threading.Lock() # boto3's default session isn't safe to build clients from in parallel
+        self.poolSize = poolSize
+        self.clients = {}
+        self.resources = {}
+        self.tables = {}
+    
+    def getPoolSize(self):
+        if self.poolSize is None:
+            self.poolSize = Utils.getEnvInt('awsPoolSize',max(AWS_POOL_SIZE,Utils.workerConnections()))
+        return self.poolSize
+    
+    def _config(self):
+        from botocore.config import Config
+        return Config(max_pool_connections=self.getPoolSize())
+    
+    def client(self, serviceName):
+        if serviceName not in self.clients:
+            with self.lock:
+                if serviceName not in self.clients:
+                    self.clients[serviceName] = metrics.instrument(boto3.client(serviceName,config=self._config()))
+        return self.clients[serviceName]
+    
+    def resource(self, serviceName):
+        if serviceName not in self.resources:
+            with self.lock:
+                if serviceName not in self.resources:
+                    resource = boto3.resource(serviceName,config=self._config())
+                    metrics.instrument(resource.meta.client)
+                    self.resources[serviceName] = resource
+        return self.resources[serviceName]
+    
+    def table(self, tableName):
+        if tableName not in self.tables:
+            dynamodb = self.resource('dynamodb')
+            with self.lock:
+                if tableName not in self.tables:
+                    self.tables[tableName] = dynamodb.Table(tableName)
+        return self.tables[tableName]
+    
+    def clear(self):
+        with self.lock:
+            self.clients = {}
+            self.resources = {}
+            self.tables = {}
+
+aws = AWSRegistry()
+
+def getSSMClient():
+    return aws.client("ssm")
+
+def loadRequests():
+    global requests
+    if requests is None:
+        import requests as module
+        requests = module
+    return requests
+
+def loadNumpy():
+    # Only the bulk aggregation uses NumPy; without it aggregateTotals falls back to plain Python
+    global numpy, numpyLoaded
+    if not numpyLoaded:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            numpy = None
+        numpyLoaded = True
+    return numpy
+
+class RateLimitDeferred(Exception):
+    # Raised to deferrable work (resets, backfills) when Strava's budget is too low to carry on
+    pass
+
+class MemoryRateStore(object):
+    # Stand-in for the DynamoDB store, for tests and for deployments without a rateLimitTable
+    def __init__(self):
+        self.state = None
+    
+    def read(self):
+        return self.state
+    
+    def write(self, state):
+        if self.state is None or self.state['updated'] <= state['updated']:
+            self.state = dict(state)
+
+class DDBRateStore(object):
+    # One item in the rate limit table holds the latest usage any of our functions has seen
+    KEY = "strava"
+    
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.table = None
+    
+    def _getTable(self):
+        if self.table is None:
+            self.table = aws.table(self.tableName)
+        return self.table
+    
+    def read(self):
+        item = self._getTable().get_item(Key={'Id': self.KEY})
+        if "Item" not in item:
+            return None
+        return {key: (value if key == 'day' else int(value)) for key, value in item['Item'].items() if key != 'Id'}
+    
+    def write(self, state):
+        item = dict(state)
+        item['Id'] = self.KEY
+        try:
+            # Never let an older observation overwrite a newer one from another container
+            self._getTable().put_item(
+                Item=item,
+                ConditionExpression="attribute_not_exists(updated) OR updated < :u",
+                ExpressionAttributeValues={':u': state['updated']}
+                )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+class RateBudget(object):
+    # Strava rate limits are per application, with 15 minute windows (starting on the quarter
+    # hour) and a daily window (midnight UTC). Every response tells us the current usage, which
+    # we keep here and in a shared store so every function and container sees the same budget.
+    # Live traffic is never held back; deferrable work waits for the next window (or gives up
+    # with RateLimitDeferred) once usage reaches the reserve kept back for live traffic.
+    HEADERS = [("X-RateLimit-Limit","X-RateLimit-Usage"),("X-ReadRateLimit-Limit","X-ReadRateLimit-Usage")]
+    
+    def __init__(self, store=None, reserve=RATE_LIMIT_RESERVE, maxWait=RATE_LIMIT_MAX_WAIT):
+        self.store = store
+        self.reserve = reserve
+        self.maxWait = maxWait
+        self.lock = threading.Lock()
+        self.state = None
+        self.synced = 0
+    
+    def getStore(self):
+        if self.store is None:
+            tableName = os.environ.get('rateLimitTable')
+            if tableName:
+                self.store = DDBRateStore(tableName)
+            else:
+                self.store = MemoryRateStore()
+        return self.store
+    
+    @staticmethod
+    def window(now):
+        return int(now//900)*900
+    
+    @staticmethod
+    def day(now):
+        return time.strftime("%Y-%m-%d",time.gmtime(now))
+    
+    def parse(self, headers, now=None):
+        # Of the overall and read limits, keep whichever is closest to running out
+        if now is None:
+            now = time.time()
+        state = None
+        for limitHeader, usageHeader in self.HEADERS:
+            if limitHeader not in headers or usageHeader not in headers:
+                continue
+            try:
+                limit15, limitDay = [int(value) for value in headers[limitHeader].split(",")[:2]]
+                usage15, usageDay = [int(value) for value in headers[usageHeader].split(",")[:2]]
+            except ValueError:
+                logger.error("Could not read {HEADER}: {VALUE}".format(HEADER=usageHeader,VALUE=headers[usageHeader]))
+                continue
+            if state is None:
+                state = {"limit15":limit15,"usage15":usage15,"limitDay":limitDay,"usageDay":usageDay}
+            if usage15/max(limit15,1) > state['usage15']/max(state['limit15'],1):
+                state['limit15'] = limit15
+                state['usage15'] = usage15
+            if usageDay/max(limitDay,1) > state['usageDay']/max(state['limitDay'],1):
+                state['limitDay'] = limitDay
+                state['usageDay'] = usageDay
+        if state is not None:
+            state['window'] = self.window(now)
+            state['day'] = self.day(now)
+            state['updated'] = int(now*1000)
+        return state
+    
+    def record(self, headers):
+        now = time.time()
+        state = self.parse(headers,now)
+        if state is not None:
+            self._save(state,now)
+    
+    def recordThrottled(self):
+        # A 429 means this window is gone, whatever we thought before
+        now = time.time()
+        with self.lock:
+            state = dict(self.state) if self.state is not None else {"limit15":1,"limitDay":1,"usageDay":0}
+        state['usage15'] = state['limit15']
+        state['window'] = self.window(now)
+        state['day'] = self.day(now)
+        state['updated'] = int(now*1000)
+        logger.error("Strava has rate limited us")
+        self._save(state,now,force=True)
+    
+    def _save(self, state, now, force=False):
+        with self.lock:
+            if self.state is None or self.state['updated'] <= state['updated']:
+                self.state = state
+            write = force or now - self.synced >= RATE_STORE_INTERVAL or self.isLow(state,now) is not None
+            if write:
+                self.synced = now
+        if write:
+            try:
+                self.getStore().write(state)
+            except Exception as e:
+                logger.error("Failed to share the rate limit usage")
+                logger.error(e)
+    
+    def current(self, now=None):
+        # Our latest view, picking up what other containers have seen if ours is stale
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stale = now - self.synced >= RATE_STORE_INTERVAL
+            if stale:
+                self.synced = now
+        if stale:
+            try:
+                shared = self.getStore().read()
+            except Exception as e:
+                logger.error("Failed to read the shared rate limit usage")
+                logger.error(e)
+                shared = None
+            with self.lock:
+                if shared is not None and (self.state is None or self.state['updated'] < shared['updated']):
+                    self.state = shared
+        with self.lock:
+            return None if self.state is None else dict(self.state)
+    
+    def isLow(self, state, now):
+        # Which window (if either) has eaten into the reserve; usage in a past window no longer counts
+        if state is None:
+            return None
+        if state['day'] == self.day(now) and state['usageDay'] >= state['limitDay']*(1-self.reserve):
+            return "daily"
+        if state['window'] == self.window(now) and state['usage15'] >= state['limit15']*(1-self.reserve):
+            return "15 minute"
+        return None
+    
+    def acquire(self, deferrable=False):
+        if not deferrable:
+            return
+        deadline = time.time()+self.maxWait
+        while True:
+            now = time.time()
+            low = self.isLow(self.current(now),now)
+            if low is None:
+                return
+            resume = self.window(now)+900+1
+            if low == "daily" or resume > deadline:
+                raise RateLimitDeferred("Strava {WINDOW} rate limit budget is reserved for live traffic".format(WINDOW=low))
+            logger.info("Strava {WINDOW} rate limit budget is low; pausing for {SECS:0.0f}s".format(WINDOW=low,SECS=resume-now))
+            time.sleep(resume-now)
+
+budget = RateBudget()
+
+class ActivityCache(object):
+    # A small LRU of detailed activities keyed on (athleteId, activityId). Entries remember
+    # when they were fetched, so anything older than maxAge, or older than the event that
+    # is asking for it (i.e. the activity has been edited since), gets fetched again.
+    def __init__(self, size=ACTIVITY_CACHE_SIZE, maxAge=ACTIVITY_MAX_AGE):
+        self.size = size
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def isFresh(self, fetchedAt, notBefore=None):
+        if fetchedAt is None:
+            return False
+        if notBefore is not None and int(fetchedAt) < int(notBefore):
+            return False
+        return time.time() - int(fetchedAt) <= self.maxAge
+    
+    def get(self, key, notBefore=None):
+        with self.lock:
+            if key in self.entries:
+                fetchedAt, activity = self.entries[key]
+                if self.isFresh(fetchedAt,notBefore):
+                    self.entries.move_to_end(key)
+                    self.hits+=1
+                    return copy.deepcopy(activity)
+                del self.entries[key]
+            self.misses+=1
+            return None
+    
+    def put(self, key, activity, fetchedAt=None):
+        if fetchedAt is None:
+            fetchedAt = int(time.time())
+        with self.lock:
+            self.entries[key] = (fetchedAt, copy.deepcopy(activity))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,"size":len(self.entries)}
+
+activities = ActivityCache()
+
+class TokenManager(object):
+    # Strava tokens for every athlete this container has seen, kept in memory so using
+    # them is a dict lookup. They are refreshed a little before they expire, by one caller
+    # at a time: threads here queue on a per-athlete lock, and other containers are kept
+    # out by a lease on the athlete's totals item (refreshing twice in parallel would leave
+    # one of them holding a refresh token Strava has already replaced). Tokens are only
+    # written back when Strava actually hands us new ones.
+    def __init__(self, margin=None, lease=TOKEN_LEASE):
+        self.margin = margin
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.athleteLocks = {}
+        self.tokens = {}
+        self.refreshes = 0
+    
+    def getMargin(self):
+        if self.margin is None:
+            return Utils.getEnvInt('tokenRefreshMargin',TOKEN_REFRESH_MARGIN)
+        return self.margin
+    
+    @staticmethod
+    def isFresh(tokens, margin):
+        return tokens is not None and int(tokens['expires_at'])-margin > int(time.time())
+    
+    def put(self, athleteId, tokens):
+        # Keeps whichever tokens last longer; a record read from the table can be older than ours
+        tokens = {"expires_at": int(tokens['expires_at']),"access_token": tokens['access_token'],"refresh_token": tokens['refresh_token']}
+        with self.lock:
+            current = self.tokens.get(str(athleteId))
+            if current is None or current['expires_at'] <= tokens['expires_at']:
+                self.tokens[str(athleteId)] = tokens
+            return self.tokens[str(athleteId)]
+    
+    def get(self, strava, margin=None):
+        if margin is None:
+            margin = self.getMargin()
+        tokens = self.put(strava.athleteId, strava.tokens)
+        if self.isFresh(tokens, margin):
+            return tokens
+        with self._athleteLock(strava.athleteId):
+            tokens = self.tokens[str(strava.athleteId)]
+            if self.isFresh(tokens, margin):
+                # Another thread refreshed them while we waited
+                return tokens
+            return self._refresh(strava, margin)
+    
+    def clear(self):
+        with self.lock:
+            self.tokens = {}
+    
+    def _athleteLock(self, athleteId):
+        with self.lock:
+            return self.athleteLocks.setdefault(str(athleteId), threading.Lock())
+    
+    def _refresh(self, strava, margin):
+        table = strava._getDDBTable()
+        key = {'Id': str(strava.athleteId)}
+        for attempt in range(RETRIES+1):
+            now = int(time.time())
+            try:
+                item = table.update_item(
+                    Key=key,
+                    UpdateExpression="SET tokenLease=:lease",
+                    ConditionExpression="attribute_not_exists(tokenLease) OR tokenLease < :now",
+                    ExpressionAttributeValues={':lease': now+self.lease,':now': now},
+                    ReturnValues="ALL_NEW"
+                    )['Attributes']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # Someone else is refreshing. Ours will do while they're still valid,
+                # otherwise wait for theirs to land.
+                tokens = self.tokens[str(strava.athleteId)]
+                if self.isFresh(tokens, 0):
+                    return tokens
+                logger.info("Waiting for another refresh of athlete {} tokens".format(strava.athleteId))
+                time.sleep(PAUSE)
+                stored = table.get_item(Key=key,ConsistentRead=True,ProjectionExpression="tokens")
+                if "Item" in stored and "tokens" in stored['Item']:
+                    tokens = self.put(strava.athleteId, json.loads(stored['Item']['tokens']))
+                    if self.isFresh(tokens, 0):
+                        return tokens
+                continue
+            # We hold the lease. The stored tokens may already have been refreshed by someone else.
+            stored = self.put(strava.athleteId, json.loads(item['tokens']))
+            tokens = stored
+            try:
+                if not self.isFresh(stored, margin):
+                    logger.info("Need to refresh Strava Tokens")
+                    tokens = self.put(strava.athleteId, strava._getTokensWithRefresh(stored['refresh_token']))
+                    self.refreshes+=1
+            finally:
+                if tokens != stored:
+                    table.update_item(
+                        Key=key,
+                        UpdateExpression="SET tokens=:t REMOVE tokenLease",
+                        ExpressionAttributeValues={':t': json.dumps(tokens)}
+                        )
+                    logger.info("Got new Strava tokens")
+                else:
+                    table.update_item(Key=key,UpdateExpression="REMOVE tokenLease")
+            return tokens
+        raise ConnectionError("Couldn't refresh the Strava tokens for athlete {}".format(strava.athleteId))
+
+tokenManager = TokenManager()
 
 class Strava:
     STRAVA_API_URL = "https://www.strava.com/api/v3"
@@ -45,6 +793,15 @@ class Strava:
         "weight training session"]
     
     STRETCH_PERCENT = 1.1
+    STRAVA_MAX_PER_PAGE = 200
+    DDB_BATCH_WRITE_LIMIT = 25
+    DDB_BATCH_GET_LIMIT = 100
+    DETAILS_TIME_INDEX = "searchForAthleteInTimeRange"
+    PROFILE_FIELDS = ["id","username","firstname","lastname","city","state","country","sex","profile_medium","profile"]
+    CLAIM_PROCESSING = "processing"
+    CLAIM_DONE = "done"
+    CLAIM_ACQUIRED = "acquired"
+    CLAIM_HELD = "held"
     
     def __init__(self, athleteId: int = None, auth:str = None, stravaClientId:str = None, stravaClientSecret:str = None):
         
@@ -64,6 +821,7 @@ class Strava:
         self.ddbDetailTableName=Utils.getEnv("detailsTable")
         
         self.solly = False ## If it's false, and we have the permission to, we'll write to the strava activity
+        self.athlete = None
         if auth is not None:
             self.registrationResult = self._newAthlete(auth)
         elif athleteId is not None:
@@ -89,7 +847,8 @@ class Strava:
             if athlete_record is None:
                 # Just in case everythin else fails, write some stuff to the db
                 self._putAthleteToDB()
-                self._writeTokens()
+                # The token exchange hands us the athlete's profile for free
+                self._putProfile(new_tokens['athlete'])
                 # Check to see if club mode is active, and if they are a member of the club
                 clubId = Utils.getSSM("StravaClubId")
                 logger.info("Required ClubId = '{CLUBID}'".format(CLUBID=clubId))
@@ -103,7 +862,7 @@ class Strava:
                         clubs = self._get(endpoint = "{STRAVA}/athlete/clubs?page={PAGE}&per_page={PER_PAGE}".format(STRAVA=self.STRAVA_API_URL,PAGE=page,PER_PAGE=PER_PAGE))
                         if len(clubs)==0:
                             break
-                        logger.info(clubs)
+                        Utils.logPayload("Clubs page {PAGE}".format(PAGE=page),clubs)
                         for club in clubs:
                             if club['id'] == int(clubId):
                                 found = True
@@ -125,9 +884,17 @@ class Strava:
                 logger.info("Net new athlete. Welcome!")
                 
                 # Get any existing data for runs, rides or swims they may have done, and add these as the starting status for the body element
-                self.buildTotals()
+                # The athlete is waiting on this, so it isn't deferrable
+                try:
+                    self.buildTotals(deferrable=False)
+                except ConnectionError as e:
+                    # They're registered all the same; the next reset fills their totals in
+                    logger.error("Couldn't build totals for the new athlete")
+                    logger.error(e)
+            else:
+                # A returning athlete; the code has just given us new tokens
+                self._writeTokens()
             
-            self._writeTokens()
             success = {
                     "statusCode": 200,
                     "headers": {
@@ -137,82 +904,173 @@ class Strava:
                 }
             return success
         else:
-            exit() # Don't give them any detail about the failure
+            raise ConnectionError("Couldn't get tokens for the registration code") # Don't give them any detail about the failure
             
     def flattenTotals(self):
         logger.info("Flattening totals for this athlete")
         
         current_year = datetime.datetime.now().year
-        start_epoch = datetime.datetime(current_year,1,1,0,0).timestamp()
         
-        athlete = self._getAthleteFromDDB()
-        newbody = json.loads(athlete['body'])
-        logger.info(newbody)
-        newbody = newbody.pop(str(current_year))
-        logger.info(newbody)
-        self._updateAthleteOnDB(json.dumps(newbody))
-        self._writeTokens()
+        self._replaceTotals({},[str(current_year)])
         
         logger.info("Done flattening totals for this athlete")
             
-    def buildTotals(self):
+    def buildTotals(self, deferrable=True):
+        # Backfills are deferrable by default, so they give way to live traffic when Strava's
+        # budget runs low (raising RateLimitDeferred if they can't wait it out)
         logger.info("Building totals for this athlete")
         current_year = datetime.datetime.now().year
         start_epoch = datetime.datetime(current_year,1,1,0,0).timestamp()
-        page = 1
-        PER_PAGE = 30
-        content = {}
-        while True:
-            activities = self._get(endpoint = "{STRAVA}/activities?after={EPOCH}&page={PAGE}&per_page={PER_PAGE}".format(STRAVA=self.STRAVA_API_URL,EPOCH=start_epoch,PAGE=page,PER_PAGE=PER_PAGE))
-            ## Add all activities to the details table
-            for activity in activities:
+        activities = self.getActivitiesSince(start_epoch,deferrable=deferrable)
+        for activity in activities:
+            activity['type'] = activity['type'].replace("Virtual","")
+        ## Add all activities to the details table
+        result = self.putDetailActivities(activities)
+        logger.info("{NEW} new activities stored, {FAILED} failed".format(NEW=len(result['new']),FAILED=len(result['failed'])))
+        stored = []
+        for activity in activities:
+            if int(activity['id']) in result['failed']:
+                logger.error("Failed to add activity {ID}; trying to continue. This event will not be added to the totals.".format(ID=activity['id']))
+                continue
+            # The totals are rebuilt from scratch, so everything we managed to store counts
+            stored.append(activity)
+        content = self.aggregateActivities(stored)
+        ## Write the totals to the DDB table in one go, leaving other years alone
+        self._replaceTotals(content,[str(current_year)])
+        logger.info("Done building totals for this athlete ({COUNT} activities)".format(COUNT=len(activities)))
+    
+    def recomputeTotals(self, gapFill=True, deferrable=True):
+        # Rebuild this year's totals from the details table rather than Strava. Only activities
+        # newer than the latest one we hold are fetched from Strava (if gapFill).
+        logger.info("Recomputing totals for this athlete from the details table")
+        current_year = datetime.datetime.now().year
+        start_epoch = int(datetime.datetime(current_year,1,1,0,0).timestamp())
+        end_epoch = int(datetime.datetime(current_year+1,1,1,0,0).timestamp())-1
+        latest = start_epoch
+        seen = set()
+        legacy = []
+        columns = {"types": [], "distances": [], "durations": [], "epochs": []}
+        for row in self._iterDetailsInRange(start_epoch,end_epoch):
+            seen.add(int(row['activityId']))
+            latest = max(latest,int(row['eventEpoch']))
+            if "activityType" not in row:
+                # Stored before we kept the slim attributes
+                legacy.append(int(row['activityId']))
+                continue
+            columns['types'].append(row['activityType'])
+            columns['distances'].append(Utils.fromDecimal(row['distance']))
+            columns['durations'].append(int(row['moving_time']))
+            columns['epochs'].append(int(row['eventEpoch']))
+        activities = self._getDetailEvents(legacy)
+        fetched = 0
+        if gapFill:
+            newer = [activity for activity in self.getActivitiesSince(latest,deferrable=deferrable) if int(activity['id']) not in seen]
+            for activity in newer:
                 activity['type'] = activity['type'].replace("Virtual","")
-                try:
-                    # if the activity is already in the DDB, this will excpetion
-                    self.putDetailActivity(activity)
-                except Exception as e:
-                    logger.error(traceback.format_exc())
-                    logger.error("Failed to add activity {ID}; trying to continue. This event will not be added to the totals.".format(ID=activity['id']))
-                else:
-                    # if the activity is not already in the ddb, then we can add it to the running totals
-                    content=self.updateContent(
-                            content=content,
-                            activityType=activity['type'],
-                            distance=activity['distance'], 
-                            duration=activity[self.STRAVA_DURATION_INDEX]
-                            )
-            ## Write what we have to the DDB table
-            if page == 1:
-                try:
-                    self._putAthleteToDB(json.dumps(content))
-                except:
-                    self._updateAthleteOnDB(json.dumps(content))
-            else:
-                self._updateAthleteOnDB(json.dumps(content))
-            ## Are there more activities?
-            if len(activities) < PER_PAGE:
+            failed = self.putDetailActivities(newer)['failed']
+            activities.extend(activity for activity in newer if int(activity['id']) not in failed)
+            fetched = len(newer)
+        for activity in activities:
+            columns['types'].append(activity['type'])
+            columns['distances'].append(activity['distance'])
+            columns['durations'].append(activity[self.STRAVA_DURATION_INDEX])
+            columns['epochs'].append(Utils.startEpoch(activity))
+        content = Utils.aggregateTotals(columns['types'],columns['distances'],columns['durations'],columns['epochs'])
+        self._replaceTotals(content,[str(current_year)])
+        logger.info("Done recomputing totals for this athlete ({LOCAL} from details, {FETCHED} from Strava)".format(LOCAL=len(seen),FETCHED=fetched))
+    
+    def aggregateActivities(self, activities):
+        return Utils.aggregateTotals(
+            [activity['type'] for activity in activities],
+            [activity['distance'] for activity in activities],
+            [activity[self.STRAVA_DURATION_INDEX] for activity in activities],
+            [Utils.startEpoch(activity) for activity in activities])
+    
+    def _iterDetailsInRange(self, start_epoch, end_epoch):
+        # Streams the athlete's rows from the time range index, a page at a time. The index only
+        # projects activityId, so the other attributes come from the table (still one query).
+        table = self._getDDBDetailTable()
+        args = {
+            "IndexName": self.DETAILS_TIME_INDEX,
+            "KeyConditionExpression": "athleteId = :athlete AND eventEpoch BETWEEN :start AND :end",
+            "ProjectionExpression": "activityId, eventEpoch, activityType, #distance, moving_time",
+            "ExpressionAttributeNames": {"#distance": "distance"},
+            "ExpressionAttributeValues": {":athlete": int(self.athleteId),":start": int(start_epoch),":end": int(end_epoch)}
+        }
+        while True:
+            page = table.query(**args)
+            for row in page['Items']:
+                yield row
+            if "LastEvaluatedKey" not in page:
                 break
-            page+=1
-        logger.info("Done building totals for this athlete")
-        
-    def refreshTokens(self):
-        logger.debug("We should already have some tokens. Check if we need to refresh.")
-        logger.debug(self.tokens)
-        if int(time.time()) > int(self.tokens['expires_at']):
-            logger.info("Need to refresh Strava Tokens")
-            new_tokens = self._getTokensWithRefresh()
-            logger.info("Got new Strava tokens")
-            logger.debug(new_tokens)
-            self._writeTokens(new_tokens)
+            args['ExclusiveStartKey'] = page['LastEvaluatedKey']
+    
+    def _getDetailEvents(self, activityIds):
+        table = self._getDDBDetailTable()
+        events = []
+        keys = [{'activityId': int(activityId),'athleteId': int(self.athleteId)} for activityId in activityIds]
+        for index in range(0,len(keys),self.DDB_BATCH_GET_LIMIT):
+            request = {table.name: {'Keys': keys[index:index+self.DDB_BATCH_GET_LIMIT],'ProjectionExpression': 'activityId, event'}}
+            found = self._batchWithBackoff(self.dynamodb.batch_get_item,request,'UnprocessedKeys')
+            for item in found['Responses'][table.name]:
+                if "event" in item:
+                    events.append(json.loads(item['event']))
+        return events
+    
+    def getActivitiesSince(self, epoch, workers=None, deferrable=False):
+        # Page 1 on its own (most athletes fit in one page), then waves of pages in parallel
+        # until one comes back short. Results are merged in start order, whatever order they arrived in.
+        # A page Strava didn't give us raises ConnectionError rather than passing for a short last
+        # page, as the callers replace the year's totals with whatever comes back.
+        if workers is None:
+            workers = max(1,Utils.getEnvInt('backfillWorkers',BACKFILL_WORKERS))
+        PER_PAGE = self.STRAVA_MAX_PER_PAGE
+        endpoint = "{STRAVA}/activities?after={EPOCH}&page={PAGE}&per_page={PER_PAGE}"
+        # Refresh up front so the workers don't all try to refresh the same tokens at once
+        self.refreshTokens()
+        def getPage(number):
+            page = self._get(endpoint = endpoint.format(STRAVA=self.STRAVA_API_URL,EPOCH=epoch,PAGE=number,PER_PAGE=PER_PAGE),deferrable=deferrable)
+            if not isinstance(page, list):
+                # _get hands back {} for anything that went wrong; an empty page is []
+                raise ConnectionError("Strava didn't return page {PAGE} of activities".format(PAGE=number))
+            return page
+        pages = {1: getPage(1)}
+        if len(pages[1]) == PER_PAGE:
+            page = 2
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                while True:
+                    wave = list(range(page,page+workers))
+                    logger.debug("Fetching activity pages {WAVE}".format(WAVE=wave))
+                    results = pool.map(getPage, wave)
+                    pages.update(zip(wave,results))
+                    if any(len(pages[p]) < PER_PAGE for p in wave):
+                        break
+                    page+=workers
+        activities = []
+        seen = set()
+        for page in sorted(pages):
+            for activity in pages[page]:
+                # An upload mid-backfill can shift an activity onto the next page as well
+                if activity['id'] not in seen:
+                    seen.add(activity['id'])
+                    activities.append(activity)
+            if len(pages[page]) < PER_PAGE:
+                break
+        activities.sort(key=lambda activity: (activity['start_date'],activity['id']))
+        return activities
+        
+    def refreshTokens(self, margin=None):
+        # Cheap unless the tokens are about to expire; see TokenManager
+        self.tokens = tokenManager.get(self, margin)
 
                 
     def _writeTokens(self,tokens=None):
         logger.info("Writing strava tokens to DDB")
-        logger.info(tokens)
         table = self._getDDBTable()
         logger.debug("Building token dict for storage")
         if tokens is not None:
             self.tokens = {"expires_at":tokens['expires_at'],"access_token":tokens['access_token'],"refresh_token":tokens['refresh_token']}
+        self.tokens = tokenManager.put(self.athleteId, self.tokens)
         logger.debug("Writing token dict to DB")
         table.update_item(
             Key={
@@ -234,26 +1092,210 @@ class Strava:
         logger.info("No athlete found")
         return None
     
-    def _putAthleteToDB(self,body_as_string="{}"):
+    def _putAthleteToDB(self):
         logger.info("Writing basic athlete to DDB")
         table = self._getDDBTable()
-        table.put_item(
-            Item={
-              'Id': str(self.athleteId),
-              'body': body_as_string,
-            })
-        self._writeTokens()
-            
-    def _updateAthleteOnDB(self,body_as_string: str):
-        logger.info("Updating athlete body on DDB")
+        self.tokens = tokenManager.put(self.athleteId, self.tokens)
+        item = {
+            'Id': str(self.athleteId),
+            'tokens': json.dumps(self.tokens)
+            }
+        table.put_item(Item=item)
+        self.athlete = item
+    
+    def getTotals(self):
+        # The athlete's totals in the old body format: {year: {type: {distance, duration, count}}}
+        if self.athlete is None:
+            return {}
+        return Utils.totalsFromItem(self.athlete)
+    
+    def addToTotals(self, activityType, distance, duration, activityId=None):
+        # Add one activity to this year's totals; see addActivitiesToTotals
+        return self.addActivitiesToTotals([(activityType,distance,duration)],activityId=activityId)
+    
+    def addActivitiesToTotals(self, activities, activityId=None, counted=None):
+        # Add (type, distance, duration) activities to this year's totals with a single atomic
+        # ADD, which also hands back the updated totals. Concurrent consumers can't lose each
+        # other's updates this way. If activityId is given, it's recorded as last_activity_id
+        # in the same write. The activity ids in counted are added to counted_activities, and
+        # the write only goes through if none of them are in it already; see countActivities.
+        year = str(datetime.datetime.now().year)
+        if self.athlete is not None and "body" in self.athlete and not Utils.hasTotalsAttributes(self.athlete):
+            self._migrateTotals()
+        sums = collections.OrderedDict()
+        for activityType, distance, duration in activities:
+            fields = sums.setdefault(activityType,{"distance": 0, "duration": 0, "count": 0})
+            fields['distance']+=int(distance)
+            fields['duration']+=int(duration)
+            fields['count']+=1
+        names = {}
+        values = {':year': set([year])}
+        adds = ["totals_years :year"]
+        for index, (activityType, fields) in enumerate(sums.items()):
+            for field in ["distance","duration","count"]:
+                placeholder = "{FIELD}{INDEX}".format(FIELD=field,INDEX=index if index > 0 else "")
+                names["#{}".format(placeholder)] = Utils.totalsAttributeName(year,activityType,field)
+                values[":{}".format(placeholder)] = fields[field]
+                adds.append("#{PLACEHOLDER} :{PLACEHOLDER}".format(PLACEHOLDER=placeholder))
+        conditions = []
+        if counted is not None and len(counted) > 0:
+            values[':counted'] = set(int(countedId) for countedId in counted)
+            adds.append("counted_activities :counted")
+            for index, countedId in enumerate(counted):
+                values[":c{}".format(index)] = int(countedId)
+                conditions.append("NOT contains(counted_activities, :c{})".format(index))
+        update = "ADD {ADDS}".format(ADDS=", ".join(adds))
+        if activityId is not None:
+            update += " SET last_activity_id=:id"
+            values[':id'] = activityId
+        args = {
+            "Key": {'Id': str(self.athleteId)},
+            "UpdateExpression": update,
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+            "ReturnValues": "ALL_NEW"
+        }
+        if len(conditions) > 0:
+            args['ConditionExpression'] = " AND ".join(conditions)
+        table = self._getDDBTable()
+        response = table.update_item(**args)
+        self.athlete = response['Attributes']
+        return Utils.totalsFromItem(self.athlete)
+    
+    def countActivities(self, activities, activityId=None):
+        # The webhook's way into the totals. activities are (id, type, distance, duration); the
+        # ids are recorded in the same write as the ADD, so an activity that an earlier delivery
+        # already counted (before failing later on) isn't counted again. Activities with an id
+        # of None are always counted. Hands back the totals and the ids this call counted.
+        remaining = list(activities)
+        while True:
+            guarded = [countedId for countedId, activityType, distance, duration in remaining if countedId is not None]
+            try:
+                totals = self.addActivitiesToTotals(
+                    [(activityType,distance,duration) for countedId, activityType, distance, duration in remaining],
+                    activityId=activityId,
+                    counted=guarded)
+                return totals, guarded
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            athlete = self._getAthleteFromDDB()
+            if athlete is not None:
+                self.athlete = athlete
+            already = set(int(countedId) for countedId in (athlete or {}).get('counted_activities',[]))
+            logger.info("Activities {IDS} were already counted".format(IDS=sorted(already.intersection(int(countedId) for countedId in guarded))))
+            remaining = [activity for activity in remaining if activity[0] is None or int(activity[0]) not in already]
+            if len(remaining) == 0:
+                return Utils.totalsFromItem(self.athlete or {}), []
+    
+    def _migrateTotals(self):
+        # Move totals out of the old JSON body and into native attributes, once per athlete
+        logger.info("Migrating athlete totals from body to attributes")
+        try:
+            self._replaceTotals({},[],condition="attribute_exists(body)")
+        except ClientError as e:
+            # Someone else got there first
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    
+    def _replaceTotals(self, content, years, condition=None):
+        # Bulk path: overwrite the totals for the given years with content (in body format),
+        # keeping every other year as it is. Also retires any old JSON body.
+        logger.info("Replacing athlete totals for {} on DDB".format(years))
+        athlete = self._getAthleteFromDDB()
+        if athlete is None:
+            athlete = {}
+        merged = {}
+        for year, totals in Utils.totalsFromItem(athlete).items():
+            if year not in years:
+                merged[year] = totals
+        for year in years:
+            if year in content and len(content[year]) > 0:
+                merged[year] = content[year]
+        attributes = Utils.totalsToAttributes(merged)
+        names = {}
+        values = {}
+        sets = []
+        removes = [name for name in athlete if name == "body" or (Utils.isTotalsAttribute(name) and name not in attributes)]
+        for index, (name, value) in enumerate(attributes.items()):
+            names["#a{}".format(index)] = name
+            values[":a{}".format(index)] = value
+            sets.append("#a{INDEX}=:a{INDEX}".format(INDEX=index))
+        if len(merged) > 0:
+            values[':years'] = set(merged.keys())
+            sets.append("totals_years=:years")
+        elif "totals_years" in athlete:
+            removes.append("totals_years")
+        for index, name in enumerate(removes):
+            names["#r{}".format(index)] = name
+        update = []
+        if len(sets) > 0:
+            update.append("SET {}".format(", ".join(sets)))
+        if len(removes) > 0:
+            update.append("REMOVE {}".format(", ".join("#r{}".format(index) for index in range(len(removes)))))
+        if len(update) == 0:
+            return
+        args = {
+            "Key": {'Id': str(self.athleteId)},
+            "UpdateExpression": " ".join(update),
+            "ExpressionAttributeNames": names,
+            "ReturnValues": "ALL_NEW"
+        }
+        if len(values) > 0:
+            args['ExpressionAttributeValues'] = values
+        if condition is not None:
+            args['ConditionExpression'] = condition
+        table = self._getDDBTable()
+        self.athlete = table.update_item(**args)['Attributes']
+    
+    def getProfile(self, maxAge=None):
+        # The athlete's Strava profile (name etc), as cached on their totals item
+        if maxAge is None:
+            maxAge = Utils.getEnvInt('profileMaxAge',PROFILE_MAX_AGE)
+        if self.athlete is not None and 'profile' in self.athlete:
+            if int(time.time()) - int(self.athlete.get('profileFetched',0)) < maxAge:
+                return json.loads(self.athlete['profile'])
+        return self.refreshProfile()
+    
+    def refreshProfile(self):
+        athlete = self.getCurrentAthlete()
+        if len(athlete) == 0:
+            # Strava didn't answer; an old profile is better than none
+            if self.athlete is not None and 'profile' in self.athlete:
+                return json.loads(self.athlete['profile'])
+            return athlete
+        return self._putProfile(athlete)
+    
+    def _putProfile(self, athlete):
+        logger.info("Caching athlete profile on DDB")
+        profile = {key: athlete[key] for key in self.PROFILE_FIELDS if key in athlete}
+        fetched = int(time.time())
+        table = self._getDDBTable()
+        table.update_item(
+            Key={
+                'Id': str(self.athleteId)
+            },
+            UpdateExpression="set profile=:p, profileFetched=:f",
+            ExpressionAttributeValues={
+                ':p': json.dumps(profile),
+                ':f': fetched
+            }
+        )
+        if self.athlete is not None:
+            self.athlete['profile'] = json.dumps(profile)
+            self.athlete['profileFetched'] = fetched
+        return profile
+    
+    def markReset(self, resetRun):
+        logger.info("Marking athlete as reset in run {}".format(resetRun))
         table = self._getDDBTable()
         table.update_item(
-        Key={
+            Key={
                 'Id': str(self.athleteId)
             },
-            UpdateExpression="set body=:c",
+            UpdateExpression="set last_reset_run=:c",
             ExpressionAttributeValues={
-                ':c': body_as_string
+                ':c': resetRun
             }
         )
     
@@ -277,86 +1319,221 @@ class Strava:
             'code': code,
             'grant_type': "authorization_code"
         }
-        response = requests.post(self.STRAVA_TOKEN_URL, json=data)
+        with metrics.span("Strava","POST oauth/token") as span:
+            response = Utils.getHttpSession().post(self.STRAVA_TOKEN_URL, json=data, timeout=HTTP_TIMEOUT)
+            span.status = response.status_code
         if response.status_code == 200:
-            logger.info("Got initial tokens for athlete.")
-            logger.info(response.json())
-            return response.json()
+            tokens = response.json()
+            logger.info("Got initial tokens for athlete {ID}".format(ID=tokens.get('athlete',{}).get('id')))
+            return tokens
         logger.error("Failed to get OAuth tokens")
         logger.error("{} - {}".format(response.status_code, response.content))
         return None
         
-    def _getTokensWithRefresh(self):
+    def _getTokensWithRefresh(self, refreshToken=None):
+        if refreshToken is None:
+            refreshToken = self.tokens['refresh_token']
         data = {
             'client_id': self.stravaClientId,
             'client_secret': self.stravaClientSecret,
             'grant_type': "refresh_token",
-            'refresh_token': self.tokens['refresh_token']
+            'refresh_token': refreshToken
         }
         
-        response = requests.post(self.STRAVA_TOKEN_URL, json=data)
+        with metrics.span("Strava","POST oauth/token") as span:
+            response = Utils.getHttpSession().post(self.STRAVA_TOKEN_URL, json=data, timeout=HTTP_TIMEOUT)
+            span.status = response.status_code
         if response.status_code == 200:
             return response.json()
         logger.error("Failed to get refreshed tokens")
-        logger.error(response.raw)
-        exit()
-        return None
+        logger.error("{} - {}".format(response.status_code, response.content))
+        raise ConnectionError("Strava refused to refresh the tokens for athlete {}".format(self.athleteId))
     
     def _getDDBTable(self):
         try:
             return self.ddbTable
         except AttributeError:
-            self.dynamodb = boto3.resource('dynamodb')
-            self.ddbTable = self.dynamodb.Table(self.ddbTableName)
+            self.dynamodb = aws.resource('dynamodb')
+            self.ddbTable = aws.table(self.ddbTableName)
             return self.ddbTable
     
     def _getDDBDetailTable(self):
         try:
             return self.ddbDetailTable
         except AttributeError:
-            self.dynamodb = boto3.resource('dynamodb')
-            self.ddbDetailTable = self.dynamodb.Table(self.ddbDetailTableName)
+            self.dynamodb = aws.resource('dynamodb')
+            self.ddbDetailTable = aws.table(self.ddbDetailTableName)
             return self.ddbDetailTable
             
-    def putDetailActivity(self,activity):
+    def _detailItem(self,activity):
+        # The type, distance and duration are kept alongside the event JSON so totals can be
+        # recomputed from the table without reading (or parsing) every event
+        return {
+            'activityId': int(activity['id']),
+            'athleteId': int(self.athleteId),
+            'eventEpoch': Utils.startEpoch(activity),
+            'fetchedEpoch': int(time.time()),
+            'activityType': activity['type'],
+            'distance': decimal.Decimal(str(activity['distance'])),
+            'moving_time': int(activity[self.STRAVA_DURATION_INDEX]),
+            'event': json.dumps(activity)
+            }
+    
+    def putDetailActivity(self,activity,processed=False):
+        # An update rather than a put, so the activity's claim (see claimActivity) isn't
+        # wiped out. With processed the claim is marked done in the same write.
         table = self._getDDBDetailTable()
+        item = self._detailItem(activity)
+        key = {'activityId': item.pop('activityId'),'athleteId': item.pop('athleteId')}
+        if processed:
+            item['webhookState'] = self.CLAIM_DONE
+        names = {}
+        values = {}
+        sets = []
+        for index, (name, value) in enumerate(item.items()):
+            names["#a{}".format(index)] = name
+            values[":v{}".format(index)] = value
+            sets.append("#a{INDEX}=:v{INDEX}".format(INDEX=index))
+        expression = "SET {}".format(", ".join(sets))
+        if processed:
+            expression += " REMOVE webhookLease"
         try:
-            table.put_item(
-                Item={
-                  'activityId': int(activity['id']),
-                  'athleteId': int(self.athleteId),
-                  'eventEpoch': int(datetime.datetime.strptime(activity['start_date'],"%Y-%m-%dT%H:%M:%SZ").timestamp()),
-                  'event': json.dumps(activity)
-                })
+            table.update_item(Key=key,UpdateExpression=expression,ExpressionAttributeNames=names,ExpressionAttributeValues=values)
         except:
+            if not processed:
+                raise
+            # The activity itself wouldn't store, but it has still been counted
             table.update_item(
-                Key={'activityId': int(activity['id']),'athleteId': int(self.athleteId)},
-                AttributeUpdates={
-                  'event':{
-                    'Value':json.dumps(activity),
-                    'Action':'PUT'}
-                })
+                Key=key,
+                UpdateExpression="SET webhookState=:done REMOVE webhookLease",
+                ExpressionAttributeValues={':done': self.CLAIM_DONE})
+            raise
+    
+    def claimActivity(self,activityId,lease=None):
+        # Decides in one conditional write whether this delivery of a webhook activity is ours
+        # to process: it is (CLAIM_ACQUIRED) unless another delivery has already finished it
+        # (CLAIM_DONE), or is working on it and its lease hasn't run out (CLAIM_HELD). Strava
+        # redelivers, and batches run concurrently, so a read-then-write check would let
+        # duplicates through. A held claim should be retried: its holder may have died.
+        if lease is None:
+            lease = Utils.getEnvInt('claimLease',CLAIM_LEASE)
+        now = int(time.time())
+        table = self._getDDBDetailTable()
+        try:
+            table.update_item(
+                Key={'activityId': int(activityId),'athleteId': int(self.athleteId)},
+                UpdateExpression="SET webhookState=:processing, webhookLease=:lease",
+                ConditionExpression="attribute_not_exists(webhookState) OR (webhookState = :processing AND webhookLease < :now)",
+                ExpressionAttributeValues={
+                    ':processing': self.CLAIM_PROCESSING,
+                    ':lease': now+lease,
+                    ':now': now
+                    })
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            found = table.get_item(
+                Key={'activityId': int(activityId),'athleteId': int(self.athleteId)},
+                ProjectionExpression="webhookState",
+                ConsistentRead=True)
+            if found.get('Item',{}).get('webhookState') == self.CLAIM_DONE:
+                return self.CLAIM_DONE
+            return self.CLAIM_HELD
+        return self.CLAIM_ACQUIRED
+    
+    def releaseActivity(self,activityId):
+        # Give up a claim without finishing, so a retry can have it straight away
+        table = self._getDDBDetailTable()
+        try:
+            table.update_item(
+                Key={'activityId': int(activityId),'athleteId': int(self.athleteId)},
+                UpdateExpression="REMOVE webhookState, webhookLease",
+                ConditionExpression="webhookState = :processing",
+                ExpressionAttributeValues={':processing': self.CLAIM_PROCESSING})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    
+    def putDetailActivities(self,activities):
+        # Bulk version of putDetailActivity. Returns the ids that weren't in the table
+        # before ('new') and the ids that couldn't be written at all ('failed').
+        table = self._getDDBDetailTable()
+        items = {}
+        for activity in activities:
+            items[int(activity['id'])] = self._detailItem(activity)
+        existing = set()
+        keys = [{'activityId': activityId,'athleteId': int(self.athleteId)} for activityId in items]
+        for index in range(0,len(keys),self.DDB_BATCH_GET_LIMIT):
+            request = {table.name: {'Keys': keys[index:index+self.DDB_BATCH_GET_LIMIT],'ProjectionExpression': 'activityId, webhookState, webhookLease'}}
+            found = self._batchWithBackoff(self.dynamodb.batch_get_item,request,'UnprocessedKeys')
+            for item in found['Responses'][table.name]:
+                existing.add(int(item['activityId']))
+                # Puts replace the whole row, so carry any webhook claim over
+                for name in ['webhookState','webhookLease']:
+                    if name in item:
+                        items[int(item['activityId'])][name] = item[name]
+            for key in found['Unprocessed'].get(table.name,{}).get('Keys',[]):
+                # Couldn't tell, so err on the side of it already being there
+                existing.add(int(key['activityId']))
+        failed = set()
+        puts = [{'PutRequest': {'Item': item}} for item in items.values()]
+        for index in range(0,len(puts),self.DDB_BATCH_WRITE_LIMIT):
+            written = self._batchWithBackoff(self.dynamodb.batch_write_item,{table.name: puts[index:index+self.DDB_BATCH_WRITE_LIMIT]},'UnprocessedItems')
+            for unprocessed in written['Unprocessed'].get(table.name,[]):
+                failed.add(int(unprocessed['PutRequest']['Item']['activityId']))
+        return {
+            "new": set(activityId for activityId in items if activityId not in existing and activityId not in failed),
+            "failed": failed
+            }
+    
+    def _batchWithBackoff(self,call,requestItems,unprocessedKey):
+        # Keep resending whatever DynamoDB hands back as unprocessed, backing off
+        # exponentially (with jitter) so we don't hammer a throttled table.
+        responses = {}
+        for table in requestItems:
+            responses[table] = []
+        counter = 0
+        while True:
+            response = call(RequestItems=requestItems)
+            for table, items in response.get('Responses',{}).items():
+                responses[table].extend(items)
+            requestItems = response.get(unprocessedKey,{})
+            if len(requestItems) == 0 or counter == RETRIES:
+                return {"Responses": responses,"Unprocessed": requestItems}
+            counter+=1
+            logger.debug("Retrying unprocessed batch items ({COUNT}<{RETRIES})".format(COUNT=counter,RETRIES=RETRIES))
+            time.sleep(random.uniform(0,min(0.05*(2**counter),PAUSE*5)))
+    
+    def _getDetailActivity(self,activityId):
+        table = self._getDDBDetailTable()
+        try:
+            detail = table.get_item(Key={'activityId': int(activityId),'athleteId': int(self.athleteId)})
+        except Exception as e:
+            logger.error(e)
+            return None
+        if "Item" in detail:
+            return detail['Item']
+        return None
             
     def updateContent(self, content, activityType, distance, duration):
         year = str(datetime.datetime.now().year)
-        logging.info(content)
-        logging.info(year)
+        Utils.logPayload("Totals before {YEAR} update".format(YEAR=year),content)
         if year in content:
-            logging.info("Found year")
+            logger.debug("Found year")
             if activityType in content[year]:
-                logging.info("Found activity")
+                logger.debug("Found activity")
                 content[year][activityType]['distance']=content[year][activityType]['distance']+int(distance)
                 content[year][activityType]['duration']=content[year][activityType]['duration']+int(duration)
                 content[year][activityType]['count']+=1
             else:
-                logging.info("New activity for the year")
+                logger.debug("New activity for the year")
                 content[year][activityType] = {
                   "distance":distance,
                   "duration":duration,
                   "count":1
                 }
         else:
-            logging.info("New year!")
+            logger.debug("New year!")
             content[year]={
                 activityType:{
                     "distance":distance,
@@ -444,7 +1621,6 @@ class Strava:
         activity_type = latest_event['type']
         if activity_type in self.VERBTONOUN:
             activity_type =  self.VERBTONOUN[activity_type]
-        strava_athlete = self.getCurrentAthlete()
         
         latest_activity_mph = Utils.secAndMetersToMPH(latest_event['distance'],latest_event[self.STRAVA_DURATION_INDEX])
         ytd_activity_mph = Utils.secAndMetersToMPH(ytd['distance']-latest_event['distance'],ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX])
@@ -460,6 +1636,7 @@ class Strava:
         
         name = "I"
         if Utils.getSSM("StravaClubId") is not None:
+            strava_athlete = self.getProfile()
             name = "{FIRSTNAME} {LASTNAME}".format(FIRSTNAME=strava_athlete['firstname'],LASTNAME=strava_athlete['lastname'])
         
         tagtemplate = {
@@ -530,13 +1707,48 @@ class Strava:
         return status
     
     def getTags(self,latest_event,ytd,distance_sum,duration_sum,count_sum):
+        tags = self._evaluateTags(latest_event,ytd,distance_sum,duration_sum,count_sum)
+        ## RARE MILESTONES
+        random.shuffle(tags)
         
+        return tags
+    
+    def replayTags(self, activities):
+        # The tags each activity would have got when it was posted, for a whole history at once.
+        # Activities are walked in start order keeping running totals (per type, and overall)
+        # for each year, so every rule is O(1) per activity.
+        ordered = sorted(activities, key=lambda activity: (activity['start_date'],activity['id']))
+        results = []
+        year = None
+        for activity in ordered:
+            if activity['start_date'][:4] != year:
+                year = activity['start_date'][:4]
+                byType = {}
+                overall = {"distance":0,"duration":0,"count":0}
+            event = dict(activity, type=activity['type'].replace("Virtual",""))
+            ytd = byType.setdefault(event['type'],{"distance":0,"duration":0,"count":0})
+            for totals in [ytd, overall]:
+                totals['distance']+=event['distance']
+                totals['duration']+=event[self.STRAVA_DURATION_INDEX]
+                totals['count']+=1
+            tags = self._evaluateTags(event,ytd,overall['distance'],overall['duration'],overall['count'])
+            results.append({"id": activity['id'],"start_date": activity['start_date'],"tags": tags})
+        return results
+    
+    def _evaluateTags(self,latest_event,ytd,distance_sum,duration_sum,count_sum):
+        # ytd and the sums already include latest_event
         activity_type = latest_event['type']
         if activity_type in self.VERBTONOUN:
             activity_type =  self.VERBTONOUN[activity_type]
-            
-        latest_event_speed = latest_event['distance']/latest_event[self.STRAVA_DURATION_INDEX]
-        ytd_speed = (ytd['distance']-latest_event['distance'])/(ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX])
+        
+        # Comparisons with "the year so far" only make sense once there is one
+        previous_count = ytd['count']-1
+        latest_event_speed = 0
+        if latest_event[self.STRAVA_DURATION_INDEX] > 0:
+            latest_event_speed = latest_event['distance']/latest_event[self.STRAVA_DURATION_INDEX]
+        ytd_speed = None
+        if ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX] > 0:
+            ytd_speed = (ytd['distance']-latest_event['distance'])/(ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX])
             
         tags = []
         if math.floor(distance_sum/100000) != math.floor((distance_sum-latest_event['distance'])/100000):
@@ -571,13 +1783,13 @@ class Strava:
         if ytd['count']%10 == 0:
             #  If they've just done a multiple of 10 activities for the entire year
             tags.append("🔟")
-        if latest_event_speed > ytd_speed*self.STRETCH_PERCENT:
+        if ytd_speed is not None and latest_event_speed > ytd_speed*self.STRETCH_PERCENT:
             # If they were more than n% faster than the year average for this activity
             tags.append("🤩")
-        if latest_event['distance'] > ((ytd['distance']-latest_event['distance'])/(ytd['count']-1))*self.STRETCH_PERCENT:
+        if previous_count > 0 and latest_event['distance'] > ((ytd['distance']-latest_event['distance'])/previous_count)*self.STRETCH_PERCENT:
             # If this was longer (distance) than the average by more than n%
             tags.append("💨")
-        if latest_event[self.STRAVA_DURATION_INDEX] > ((ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX])/(ytd['count']-1))*self.STRETCH_PERCENT:
+        if previous_count > 0 and latest_event[self.STRAVA_DURATION_INDEX] > ((ytd['duration']-latest_event[self.STRAVA_DURATION_INDEX])/previous_count)*self.STRETCH_PERCENT:
             # If they spent n% longer than normal doing this activity
             tags.append("⏱️")
         
@@ -586,28 +1798,36 @@ class Strava:
             if "pr_count" in latest_event and latest_event['pr_count'] > 0:
                 pr_count = latest_event['pr_count']
             tags.append('{PRs}{ACHs}'.format(PRs = "🌟"*min(pr_count,5), ACHs = "⭐"*max(min(latest_event['achievement_count']-pr_count,5),0)))
-            
-        ## RARE MILESTONES
-        random.shuffle(tags)
         
         return tags
                 
-    def _get(self,endpoint):
+    def _get(self,endpoint,deferrable=False):
         counter = 0
         while True:
             try:
                 #logger.setLevel(logging.DEBUG)
+                budget.acquire(deferrable)
                 logger.debug("Checking if tokens need a refresh")
                 self.refreshTokens()
                 logger.debug("Sending GET request to strava endpoint")
-                logger.debug(self.tokens['access_token'])
-                activity = requests.get(
-                    endpoint,
-                    headers={'Authorization':"Bearer {ACCESS_TOKEN}".format(ACCESS_TOKEN=self.tokens['access_token'])}
-                    )
+                with metrics.span("Strava","GET {}".format(Utils.metricPath(endpoint))) as span:
+                    span.retries = counter
+                    activity = Utils.getHttpSession().get(
+                        endpoint,
+                        headers={'Authorization':"Bearer {ACCESS_TOKEN}".format(ACCESS_TOKEN=self.tokens['access_token'])},
+                        timeout=HTTP_TIMEOUT
+                        )
+                    span.status = activity.status_code
+                budget.record(activity.headers)
                 if activity.status_code == 200:
                     logger.debug("All good. Returning.")
                     return activity.json()
+                elif activity.status_code == 429:
+                    budget.recordThrottled()
+                    if deferrable:
+                        raise RateLimitDeferred("Strava returned 429 for {}".format(endpoint))
+                    logger.error("Rate limited by Strava getting {}".format(endpoint))
+                    return {}
                 elif 400 <= activity.status_code <= 599:
                     logger.error("Got an error returned")
                     logger.error("code:{CODE}\nmessage:{MESSAGE}".format(CODE=activity.status_code,MESSAGE=activity.text))
@@ -620,6 +1840,9 @@ class Strava:
                     logger.debug("Failed ({COUNT}<{RETRIES}), but going to retry.".format(COUNT=counter,RETRIES=RETRIES))
                     counter+=1
                     time.sleep(PAUSE)
+            except (RateLimitDeferred, ConnectionError):
+                # Out of budget, or we couldn't get tokens; either way there's no point carrying on
+                raise
             except Exception as e:
                 logger.error("An Exception occured while getting {} ".format(endpoint))
                 logger.error(e)
@@ -633,14 +1856,19 @@ class Strava:
                 logger.debug("Checking if tokens need a refresh")
                 self.refreshTokens()
                 logger.debug("Sending PUT request to strava endpoint")
-                logger.debug(self.tokens['access_token'])
-                activity = requests.put(
-                    endpoint,
-                    headers={'Authorization':"Bearer {ACCESS_TOKEN}".format(ACCESS_TOKEN=self.tokens['access_token'])},
-                    data=body,
-                    timeout=PAUSE*5
-                    )
+                with metrics.span("Strava","PUT {}".format(Utils.metricPath(endpoint))) as span:
+                    span.retries = counter
+                    activity = Utils.getHttpSession().put(
+                        endpoint,
+                        headers={'Authorization':"Bearer {ACCESS_TOKEN}".format(ACCESS_TOKEN=self.tokens['access_token'])},
+                        data=body,
+                        timeout=HTTP_TIMEOUT
+                        )
+                    span.status = activity.status_code
                 logger.debug("Returned from PUT request")
+                budget.record(activity.headers)
+                if activity.status_code == 429:
+                    budget.recordThrottled()
                 if activity.status_code == 200:
                     logger.debug("All good. Returning.")
                     return activity.json()
@@ -656,18 +1884,49 @@ class Strava:
                     logger.debug("Failed ({COUNT}<{RETRIES}), but going to retry.".format(COUNT=counter,RETRIES=RETRIES))
                     counter+=1
                     time.sleep(PAUSE)
+            except ConnectionError:
+                raise
             except Exception as e:
                 logger.error("An Exception occured while putting to {} ".format(endpoint))
                 logger.error(e)
                 return None
                 
-    def getActivity(self,activityId):
+    def getActivity(self,activityId,notBefore=None):
+        # Read through the in-memory cache, then the copy in the details table, and only
+        # then go to Strava. notBefore (an epoch, e.g. the webhook event_time) forces a
+        # refetch of anything we fetched before the activity last changed.
+        key = (str(self.athleteId),int(activityId))
+        activity = activities.get(key,notBefore)
+        if activity is not None:
+            logger.debug("Activity {ID} served from cache".format(ID=activityId))
+            return activity
+        detail = self._getDetailActivity(activityId)
+        if detail is not None and "event" in detail and activities.isFresh(detail.get('fetchedEpoch'),notBefore):
+            activity = json.loads(detail['event'])
+            # Only detailed representations (resource_state 3) are good enough; backfills store summaries
+            if activity.get('resource_state') == 3:
+                logger.debug("Activity {ID} served from the details table".format(ID=activityId))
+                activities.put(key,activity,int(detail['fetchedEpoch']))
+                return activity
         endpoint = "{STRAVA}/activities/{ID}".format(STRAVA=self.STRAVA_API_URL,ID=activityId)
-        return(self._get(endpoint))
+        activity = self._get(endpoint)
+        if len(activity) > 0:
+            activities.put(key,activity)
+        return activity
         
     def getCurrentAthlete(self):
-        endpoint = "{STRAVA}/athlete".format(STRAVA=self.STRAVA_API_URL)
-        return(self._get(endpoint))
+        try:
+            return self.currentAthlete
+        except AttributeError:
+            endpoint = "{STRAVA}/athlete".format(STRAVA=self.STRAVA_API_URL)
+            athlete = self._get(endpoint)
+            if len(athlete) > 0:
+                self.currentAthlete = athlete
+            return athlete
+    
+    @staticmethod
+    def clearActivityCache():
+        activities.clear()
         
     def getAthlete(self,athleteId):
         endpoint = "{STRAVA}/athletes/{ID}/stats".format(STRAVA=self.STRAVA_API_URL,ID=athleteId)
@@ -681,23 +1940,235 @@ class Utils(object):
     
     @staticmethod
     def getSSM(parameterName):
-        parameterFullName="{PREFIX}{PARAMNAME}".format(PREFIX=Utils.getEnv('ssmPrefix'),PARAMNAME=parameterName)
-        logger.info("Getting {PARAM} from parameter store".format(PARAM=parameterName))
-        try:
-            return ssm.get_parameter(Name=parameterFullName)['Parameter']['Value']
-        except Exception as e:
-            logger.error(e)
-            logger.error("No {PARAM} set in SSM parameter store".format(PARAM=parameterFullName))
-            return None
+        return parameters.get(parameterName)
+    
+    @staticmethod
+    def invalidateSSM(parameterName=None):
+        parameters.invalidate(parameterName)
+    
+    @staticmethod
+    def getSSMStats():
+        return parameters.stats()
     
     @staticmethod
     def setSSM(parameterName,parameterValue):
       parameterFullName="{PREFIX}{PARAMNAME}".format(PREFIX=Utils.getEnv('ssmPrefix'),PARAMNAME=parameterName)
+      client = getSSMClient()
       try:
-        ssm.set_parameter(Name=parameterFullName,Value=parameterValue)
-      except ssm.exceptions.ParameterAlreadyExists as e:
-        ssm.delete_parameter(Name=parameterFullName)
-        ssm.set_parameter(Name=parameterFullName,Value=parameterValue)
+        client.set_parameter(Name=parameterFullName,Value=parameterValue)
+      except client.exceptions.ParameterAlreadyExists as e:
+        client.delete_parameter(Name=parameterFullName)
+        client.set_parameter(Name=parameterFullName,Value=parameterValue)
+      parameters.invalidate(parameterName)
+    
+    @staticmethod
+    def metricPath(url):
+        # An endpoint as a metric dimension: no host, query or ids, so there are only a handful
+        path = url.split("?")[0].replace(Strava.STRAVA_API_URL,"").strip("/")
+        return "/".join("{id}" if part.isdigit() else part for part in path.split("/"))
+    
+    @staticmethod
+    def flushMetrics(function):
+        return metrics.flush(function)
+    
+    @staticmethod
+    def logPayload(label, payload, level=None):
+        payloads.log(label, payload, level)
+    
+    @staticmethod
+    def resetLogBudget():
+        payloads.reset()
+    
+    @staticmethod
+    def declareWorkers(**defaults):
+        # A handler's default worker counts (keyed by their WORKER_SETTINGS name), so the AWS and
+        # HTTP pools are sized for the threads it really runs. Call it at import, before any
+        # client or session is made.
+        worker_defaults.update(defaults)
+    
+    @staticmethod
+    def workerConnections():
+        # A handler's pools all run at once, and nested work (eg. a reset worker's page fetches
+        # or batch writes) can double up on a worker's connections
+        threads = sum(max(1,Utils.getEnvInt(name,default)) for name, default in worker_defaults.items())
+        widest = max([threads]+[Utils.getEnvInt(name,0) for name in WORKER_SETTINGS]+[BACKFILL_WORKERS,SCAN_SEGMENTS])
+        return widest*2
+    
+    @staticmethod
+    def getHttpSession():
+        # One pooled keep-alive session per container, shared by every athlete and
+        # reused across warm invocations so we only pay the TLS handshake once.
+        global http
+        if http is None:
+            with http_lock:
+                if http is None:
+                    poolSize = Utils.getEnvInt('httpPoolSize',max(HTTP_POOL_SIZE,Utils.workerConnections()))
+                    requests = loadRequests()
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+                    http = session
+        return http
+    
+    @staticmethod
+    def totalsAttributeName(year, activityType, field):
+        return "{PREFIX}{YEAR}:{TYPE}:{FIELD}".format(PREFIX=TOTALS_PREFIX,YEAR=year,TYPE=activityType,FIELD=field)
+    
+    @staticmethod
+    def isTotalsAttribute(name):
+        return name.startswith(TOTALS_PREFIX)
+    
+    @staticmethod
+    def hasTotalsAttributes(item):
+        return any(Utils.isTotalsAttribute(name) for name in item)
+    
+    @staticmethod
+    def aggregateTotals(types, distances, durations, epochs):
+        # Totals in the body format for a whole list of activities at once, matching what
+        # calling updateContent for each of them in order would give (including its habit of
+        # keeping the first activity's values as they are and truncating the rest to ints).
+        # The year comes from each activity's start epoch (UTC).
+        if len(types) == 0:
+            return {}
+        numpy = loadNumpy()
+        if numpy is None:
+            return Utils._aggregateTotalsLoop(types, distances, durations, epochs)
+        years = numpy.asarray(epochs,dtype='int64').astype('datetime64[s]').astype('datetime64[Y]').astype('int64')+1970
+        yearKeys, yearIndex = numpy.unique(years,return_inverse=True)
+        typeKeys, typeIndex = numpy.unique(numpy.asarray(types,dtype=object).astype(str),return_inverse=True)
+        groups, first, group = numpy.unique(yearIndex*len(typeKeys)+typeIndex,return_index=True,return_inverse=True)
+        counts = numpy.bincount(group,minlength=len(groups))
+        sums = {}
+        for field, values in [("distance",distances),("duration",durations)]:
+            truncated = numpy.trunc(numpy.asarray(values,dtype='float64'))
+            sums[field] = numpy.bincount(group,weights=truncated,minlength=len(groups))-truncated[first]
+        content = {}
+        # Walk the groups in the order they first appear, as updateContent would have added them
+        for g in numpy.argsort(first,kind='stable'):
+            year = str(int(yearKeys[yearIndex[first[g]]]))
+            activityType = str(typeKeys[typeIndex[first[g]]])
+            content.setdefault(year,{})[activityType] = {
+                "distance": distances[first[g]]+int(sums['distance'][g]),
+                "duration": durations[first[g]]+int(sums['duration'][g]),
+                "count": int(counts[g])
+            }
+        return content
+    
+    @staticmethod
+    def _aggregateTotalsLoop(types, distances, durations, epochs):
+        content = {}
+        for activityType, distance, duration, epoch in zip(types, distances, durations, epochs):
+            year = str(datetime.datetime.utcfromtimestamp(int(epoch)).year)
+            totals = content.setdefault(year,{})
+            if activityType in totals:
+                totals[activityType]['distance']+=int(distance)
+                totals[activityType]['duration']+=int(duration)
+                totals[activityType]['count']+=1
+            else:
+                totals[activityType] = {"distance":distance,"duration":duration,"count":1}
+        return content
+    
+    @staticmethod
+    def startEpoch(activity):
+        return int(datetime.datetime.strptime(activity['start_date'],"%Y-%m-%dT%H:%M:%SZ").timestamp())
+    
+    @staticmethod
+    def fromDecimal(value):
+        # DynamoDB hands numbers back as Decimal; keep whole numbers as ints
+        if isinstance(value, decimal.Decimal):
+            return int(value) if value == value.to_integral_value() else float(value)
+        return value
+    
+    @staticmethod
+    def totalsFromItem(item):
+        # Totals live in native number attributes named totals:<year>:<type>:<field>, which is what
+        # lets the webhook ADD to them atomically. Older items still carry the JSON body.
+        if not Utils.hasTotalsAttributes(item):
+            if "body" in item:
+                return json.loads(item['body'])
+            return {}
+        content = {}
+        for name, value in item.items():
+            if not Utils.isTotalsAttribute(name):
+                continue
+            year, activityType, field = name[len(TOTALS_PREFIX):].split(":")
+            content.setdefault(year,{}).setdefault(activityType,{})[field] = Utils.fromDecimal(value)
+        return content
+    
+    @staticmethod
+    def totalsBefore(yearTotals, activities):
+        # A year's totals (one year of totalsFromItem) as they were before the given
+        # (type, distance, duration) activities were added by addActivitiesToTotals
+        before = copy.deepcopy(yearTotals)
+        for activityType, distance, duration in activities:
+            if activityType not in before:
+                continue
+            before[activityType]['distance']-=int(distance)
+            before[activityType]['duration']-=int(duration)
+            before[activityType]['count']-=1
+            if before[activityType]['count'] <= 0:
+                del before[activityType]
+        return before
+    
+    @staticmethod
+    def totalsToAttributes(content):
+        attributes = {}
+        for year, activities in content.items():
+            for activityType, totals in activities.items():
+                for field, value in totals.items():
+                    if isinstance(value, float):
+                        value = decimal.Decimal(str(value))
+                    attributes[Utils.totalsAttributeName(year,activityType,field)] = value
+        return attributes
+    
+    @staticmethod
+    def iterAthleteIds(segments=None, activeInYear=None):
+        # Every athlete Id in the totals table, as a generator. The table is scanned as a
+        # DynamoDB parallel scan, one thread per segment, each following LastEvaluatedKey to
+        # the end. activeInYear limits it to athletes with totals for that year.
+        if segments is None:
+            segments = max(1,Utils.getEnvInt('scanSegments',SCAN_SEGMENTS))
+        client = aws.client('dynamodb')
+        scanArgs = {"TableName": Utils.getEnv('totalsTable'),"ProjectionExpression": "Id"}
+        if activeInYear is not None:
+            scanArgs['FilterExpression'] = "contains(totals_years, :year) OR contains(body, :quotedyear)"
+            scanArgs['ExpressionAttributeValues'] = {":year": {"S": str(activeInYear)},":quotedyear": {"S": '"{YEAR}"'.format(YEAR=activeInYear)}}
+        found = queue.Queue()
+        stop = threading.Event()
+        DONE = object()
+        
+        def scanSegment(segment):
+            try:
+                args = dict(scanArgs, Segment=segment, TotalSegments=segments)
+                while not stop.is_set():
+                    page = client.scan(**args)
+                    for item in page['Items']:
+                        found.put(item['Id']['S'])
+                    if "LastEvaluatedKey" not in page:
+                        break
+                    args['ExclusiveStartKey'] = page['LastEvaluatedKey']
+            except Exception as e:
+                found.put(e)
+            finally:
+                found.put(DONE)
+        
+        threads = [threading.Thread(target=scanSegment, args=(segment,), daemon=True) for segment in range(segments)]
+        for thread in threads:
+            thread.start()
+        try:
+            running = segments
+            while running > 0:
+                item = found.get()
+                if item is DONE:
+                    running-=1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
     
     @staticmethod
     def getEnv(variableName):
@@ -706,6 +2177,15 @@ class Utils(object):
         logger.error("No {VAR} set in lambda environment".format(VAR=variableName))
         return None
     
+    @staticmethod
+    def getEnvInt(variableName, default):
+        # For optional tuning knobs, so a missing or bad value quietly means the default
+        try:
+            return int(os.environ.get(variableName,default))
+        except ValueError:
+            logger.error("{VAR} is not a number; using {DEFAULT}".format(VAR=variableName,DEFAULT=default))
+            return default
+    
     @staticmethod
     def secsToStr(seconds):
         if seconds > (86400*2)-1:
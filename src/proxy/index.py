@@ -2,22 +2,33 @@
 import json
 import os
 import logging
-import requests
-import boto3
-import datetime
 from strava import Strava
 from strava import Utils
+from strava import aws
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#lambda_client = boto3.client("lambda")
-sqs_client = boto3.client("sqs")
+# Strava gives us 2 seconds to answer a webhook POST, and the path it hits needs nothing
+# more than the layer (whose HTTP and SSM pieces load on first use) and one SQS client.
+# The client is made here, while the container starts, rather than on the first event.
+try:
+    aws.client("sqs")
+except Exception as e:
+    # Not fatal here; the first event will try again and fail properly if it must
+    logger.error("Couldn't create the SQS client at start up")
+    logger.error(e)
+
+def getAccountId(context):
+    # The webhook verify token. Our own function ARN carries the account number, so there's
+    # no need to ask STS for it (or to grant the proxy the permission to).
+    return context.invoked_function_arn.split(":")[4]
 
 def lambda_handler(event, context):
     
     logging.info("Underpants")
-    logging.info(event)
+    Utils.resetLogBudget()
+    Utils.logPayload("Event",event)
     
     returnable = {
         "statusCode": 200,
@@ -35,8 +46,7 @@ def lambda_handler(event, context):
         
         logger.info(redirectUrl)
         
-        ssm=boto3.client("ssm")
-        stravaClientId=ssm.get_parameter(Name="{}StravaClientId".format(os.environ['ssmPrefix']))['Parameter']['Value']
+        stravaClientId=Utils.getSSM("StravaClientId")
         
         returnable = {
             "statusCode": 301,
@@ -78,8 +88,7 @@ def lambda_handler(event, context):
         if event['requestContext']['http']['method'] == "GET":
             # Auth for subscription creation
             if "queryStringParameters" in event and "hub.challenge" in event['queryStringParameters']:
-                sts = boto3.client("sts")
-                if "hub.verify_token" not in event ['queryStringParameters'] or event['queryStringParameters']['hub.verify_token'] != str(sts.get_caller_identity()["Account"]):
+                if "hub.verify_token" not in event ['queryStringParameters'] or event['queryStringParameters']['hub.verify_token'] != getAccountId(context):
                     logger.error("hub.verify_token is not equal to the account number. Bailing.")
                     returnable = {
                         "statusCode": 403,
@@ -116,7 +125,7 @@ def lambda_handler(event, context):
                     #logger.info("Calling ASync lambda")
                     logger.info("Adding event to SQS")
                     #lambda_client.invoke(FunctionName=os.environ["webhookASync"],InvocationType='Event',Payload=event['body'])
-                    sqs_client.send_message(
+                    aws.client("sqs").send_message(
                         QueueUrl=Utils.getEnv("sqsUrl"),
                         MessageBody=event['body']
                     )
@@ -141,7 +150,8 @@ def lambda_handler(event, context):
                     "body": "No path matched. See logs. Doh!"
                 }
 
-    logging.info(returnable)
+    Utils.logPayload("Response",returnable)
+    Utils.flushMetrics("proxy")
     logging.info("Profit!")
     
     return returnable
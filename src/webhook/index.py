@@ -1,178 +1,399 @@
 #!/usr/bin/env python
 import json
 # pylint: disable=fixme, import-error
-from twython import Twython
-from twython import TwythonAuthError
 from datetime import datetime
 import time
-import requests
-import boto3
 import logging
-import hashlib
-import math
 from io import BytesIO
-from botocore.exceptions import ClientError
 from strava import Strava
 from strava import Utils
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from strava import metrics
 import sys
+import os
 import traceback
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+WORKERS = 4 # Athletes processed in parallel per batch; override with the webhookWorkers environment variable
+IO_WORKERS = 16 # Threads for each activity's tweet and description; override with the ioWorkers environment variable
+FETCH_WORKERS = 8 # Threads for each activity's claim and fetch; override with the fetchWorkers environment variable
+STAGE_TIMEOUTS = { #seconds each stage of an activity gets
+    "totals": 30, # how long the tweet and description wait for the totals
+    "photo": 10,
+    "tweet": 60,
+    "description": 60
+    }
+# Every one of these pools can be busy at once; the AWS and HTTP pools are sized to match
+Utils.declareWorkers(webhookWorkers=WORKERS,ioWorkers=IO_WORKERS,fetchWorkers=FETCH_WORKERS)
+
+pools = {}
+pools_lock = threading.Lock()
+twitter_client = None
+twitter_lock = threading.Lock()
+
 def lambda_handler(event, context):
 
     logging.info("Underpants")
-    logging.info(event)
-    twitter = getTwitterClient()
+    Utils.resetLogBudget()
+    Utils.logPayload("Event",event)
+    global twitter_client
+    Strava.clearActivityCache()
+    # Made afresh each invocation, but only once there's something to tweet
+    twitter_client = None
+    tweeting = tweetsEnabled()
+    
+    # Group the batch by athlete, keeping arrival order within each athlete
+    athletes = collections.OrderedDict()
     for record in event['Records']:
-        
-        recordjson = json.loads(record['body'])
+        try:
+            recordjson = json.loads(record['body'])
+            owner = str(recordjson['owner_id'])
+        except (ValueError, KeyError, TypeError) as e:
+            # Retrying won't make a malformed message any better, so let it go
+            logger.error("Dropping unreadable message {ID}".format(ID=record.get('messageId')))
+            logger.error(e)
+            continue
+        athletes.setdefault(owner,[]).append((record,recordjson))
+    
+    failures = []
+    if len(athletes) > 0:
+        # Different athletes run in parallel; each athlete's records are handled together on one worker
+        with ThreadPoolExecutor(max_workers=min(getWorkerCount(),len(athletes))) as pool:
+            for failed in pool.map(lambda records: processAthleteRecords(records,tweeting), athletes.values()):
+                failures.extend(failed)
+    
+    if len(failures) > 0:
+        logger.error("{COUNT} of {TOTAL} records failed and will be retried".format(COUNT=len(failures),TOTAL=len(event['Records'])))
+    Utils.flushMetrics("webhook")
+    logging.info("Profit!")
+    return {"batchItemFailures": [{"itemIdentifier": messageId} for messageId in failures]}
+
+def getWorkerCount():
+    return max(1,Utils.getEnvInt('webhookWorkers',WORKERS))
+
+def processAthleteRecords(records, tweeting):
+    # A device sync can bring in several of an athlete's activities at once, and SQS can
+    # deliver a message twice; exact duplicates are dropped, and the rest are handled together
+    failed = []
+    unique = collections.OrderedDict()
+    for record, recordjson in records:
+        key = (str(recordjson['owner_id']),str(recordjson.get('object_id')))
+        if key in unique:
+            logger.info("Dropping message {ID}, a duplicate of {FIRST} in this batch".format(ID=record.get('messageId'),FIRST=unique[key][0].get('messageId')))
+            continue
+        unique[key] = (record,recordjson)
+    records = list(unique.values())
+    try:
+        errors = processRecords([recordjson for record, recordjson in records], tweeting)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        errors = [e]*len(records)
+    for (record, recordjson), error in zip(records,errors):
+        if error is not None:
+            logger.error("Failed to process message {ID}".format(ID=record['messageId']))
+            failed.append(record['messageId'])
+    return failed
+
+def processRecords(recordjsons, tweeting):
+    # One athlete's activities: one athlete load and token check, claims and fetches side by
+    # side, one totals write for all of them, and posts in the order the activities started.
+    # Hands back, for each record, None or the exception that means it should be retried.
+    errors = [None]*len(recordjsons)
+    subscription_id = Utils.getSSM("subscription_id")
+    entries = []
+    for index, recordjson in enumerate(recordjsons):
         debug = False
         if "debug" in recordjson:
             logger.setLevel(logging.DEBUG)
             debug = True
-        
-        subscription_id = Utils.getSSM("subscription_id")
         if subscription_id is not None:
           if 'subscription_id' not in recordjson or int(recordjson['subscription_id']) != int(subscription_id):
             logger.error("This request does not have the checksum equal to the expected value.") # 'checksum' is obfustication, but it'll do for now
-            return
-        
-        strava = Strava(athleteId=recordjson['owner_id'])
-        
-        athlete_record = strava._getAthleteFromDDB()
-        if athlete_record is None:
-            logger.error("Something has gone wrong. We've recieved an API call for an activity owned by {}, but have no corresponding registration in our DDB table.".format(recordjson['owner_id']))
             continue
+        entries.append({"index": index, "record": recordjson, "debug": debug})
+    if len(entries) == 0:
+        return errors
+    
+    strava = Strava(athleteId=entries[0]['record']['owner_id'])
+    
+    athlete_record = strava.athlete
+    if athlete_record is None:
+        logger.error("Something has gone wrong. We've recieved an API call for an activity owned by {}, but have no corresponding registration in our DDB table.".format(entries[0]['record']['owner_id']))
+        return errors
+    # The one token check for the group; every call below reuses them
+    strava.refreshTokens()
+    
+    logger.info("Checking for race condition")
+    fetchPool = getFetchPool()
+    for entry in list(entries):
+        recordjson = entry['record']
+        # last_activity_id is what we had before claims, and costs nothing to check
+        if not entry['debug'] and "last_activity_id" in athlete_record and recordjson['object_id'] == athlete_record['last_activity_id']:
+            logger.info("Bailing on {ID} as this is a duplicate".format(ID=recordjson['object_id']))
+            entries.remove(entry)
+            continue
+        # Claim each activity and fetch it at the same time; the fetch has no side effects, so
+        # it's fine to throw it away if this turns out to be a duplicate
+        entry['claim'] = None
+        if not entry['debug']:
+            entry['claim'] = fetchPool.submit(strava.claimActivity,recordjson['object_id'])
+        # get the activity details; this is the only Strava fetch for the activity
+        entry['fetch'] = fetchPool.submit(strava.getActivity,recordjson['object_id'],notBefore=recordjson.get('event_time'))
+    
+    claimed = []
+    for entry in entries:
+        objectId = entry['record']['object_id']
+        try:
+            # No timeout: a claim given up on could still go through afterwards, and nothing
+            # would ever release it. The claims have a pool of their own, so they don't queue
+            # behind chains waiting on totals.
+            claim = entry['claim'].result() if entry['claim'] is not None else strava.CLAIM_ACQUIRED
+            if claim == strava.CLAIM_DONE:
+                logger.info("Bailing on {ID} as this is a duplicate (already done)".format(ID=objectId))
+                continue
+            if claim == strava.CLAIM_HELD:
+                # Another delivery is on it, or was and died; try again once its lease is up
+                raise RuntimeError("Activity {ID} is claimed by another delivery".format(ID=objectId))
+            try:
+                activity = entry['fetch'].result()
+                if not activity or "type" not in activity:
+                    # _get hands back {} when Strava won't give us the activity (deleted, made private...)
+                    raise ConnectionError("Strava didn't return activity {ID}".format(ID=objectId))
+                activity['type'] = activity['type'].replace("Virtual","")
+            except Exception as e:
+                # Only this activity failed; give its claim back so the retry can have it
+                if entry['claim'] is not None:
+                    strava.releaseActivity(objectId)
+                raise
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            errors[entry['index']] = e
+            continue
+        entry['activity'] = activity
+        entry['totals'] = Future()
+        entry['counted'] = Future()
+        entry['chains'] = {}
+        claimed.append(entry)
+    if len(claimed) == 0:
+        return errors
+    
+    recorded = [entry for entry in claimed if not entry['debug']]
+    try:
+        claimed.sort(key=lambda entry: (entry['activity']['start_date'],entry['activity']['id']))
+        recorded.sort(key=lambda entry: (entry['activity']['start_date'],entry['activity']['id']))
         
-        logger.info("Checking for race condition")
-        if not debug and "last_activity_id" in athlete_record and recordjson['object_id'] == athlete_record['last_activity_id']:
-            logger.info("Bailing as this is a duplicate")
-            return
-        elif not debug:
-            strava.updateLastActivity(recordjson['object_id'])
-        
-        # get the activity details
-        activity = strava.getActivity(recordjson['object_id'])
-        activity['type'] = activity['type'].replace("Virtual","")
-        
-        if "body" not in athlete_record:
-            content = strava.updateContent({},activity['type'],activity['distance'],activity['elapsed_time'])
-        else:
-            content = strava.updateContent(json.loads(athlete_record['body']),activity['type'],activity['distance'],activity['elapsed_time'])
-        
-        strava._updateAthleteOnDB(json.dumps(content))
-        
-        logger.info(content)
+        # The tweets and the descriptions only need the totals at the very end, so they start
+        # now (fetching photos and Spotify tracks) and wait for them. Each tweet also waits for
+        # the one before it, so they're posted in start order.
+        pool = getIOPool()
+        previous = None
+        for entry in claimed:
+            if tweeting:
+                previous = entry['chains']['tweet'] = pool.submit(tweetChain,strava,entry['activity'],entry['totals'],entry['debug'],previous,entry['counted'])
+            entry['chains']['description'] = pool.submit(descriptionChain,strava,entry['activity'],entry['totals'])
         
-        # put the activity into the detail table
+        # One atomic write adds every activity and hands back the updated totals. It also
+        # records them as counted, so any that an earlier delivery counted before it failed
+        # are left out rather than counted twice.
+        content, newlyCounted = strava.countActivities(
+            [(None if entry['debug'] else entry['activity']['id'],entry['activity']['type'],entry['activity']['distance'],entry['activity']['elapsed_time']) for entry in claimed],
+            activityId=recorded[-1]['record']['object_id'] if len(recorded) > 0 else None)
+    except Exception as e:
+        # Nothing has been counted, so let the retries have them
+        logger.error(traceback.format_exc())
+        for entry in claimed:
+            entry['totals'].set_exception(e)
+            entry['counted'].set_exception(e)
+            errors[entry['index']] = e
+        for entry in recorded:
+            strava.releaseActivity(entry['record']['object_id'])
+        # The chains give up as soon as they see the totals failed
+        for entry in claimed:
+            for name, chain in entry['chains'].items():
+                waitForChain(name,chain,entry['activity'])
+        return errors
+    
+    Utils.logPayload("Totals",content)
+    # Each post gets the totals as they stood just after its own activity: the final ones,
+    # less everything this write counted that started later. One counted by an earlier
+    # delivery can't be placed like that, so it gets the totals as they are now.
+    year_stats = content.get(str(datetime.now().year),{})
+    newlyCounted = set(newlyCounted)
+    counts = [(entry['activity']['type'],entry['activity']['distance'],entry['activity']['elapsed_time']) if entry['debug'] or entry['activity']['id'] in newlyCounted else None for entry in claimed]
+    for position, entry in enumerate(claimed):
+        isNew = counts[position] is not None
+        later = [count for count in counts[position+1:] if count is not None] if isNew else []
+        entry['totals'].set_result(Utils.totalsBefore(year_stats,later))
+        entry['counted'].set_result(isNew)
+    
+    for entry in claimed:
+        activity = entry['activity']
+        # put the activity into the detail table, and mark the claim as done
         try:
-            strava.putDetailActivity(activity)
+            strava.putDetailActivity(activity,processed=not entry['debug'])
         except Exception as e:
             logger.error(traceback.format_exc())
             logger.error("Failed to add activity {ID}; trying to continue. This event will not be added to the totals.".format(ID=activity['id']))
                             
         else:
-            logger.info("Activity stored in detail database ({ID})".format(ID=recordjson['object_id']))
-            
-        year = str(datetime.now().year)
-        
-        # build a string to tweet
-        # Get the activity from strava
-        activity = strava.getActivity(recordjson['object_id'])
-        activity['type'] = activity['type'].replace("Virtual","")
+            logger.info("Activity stored in detail database ({ID})".format(ID=activity['id']))
+    
+    for entry in claimed:
+        # Each chain's failure (or slowness) is its own; the activity has been counted either way
+        for name, chain in entry['chains'].items():
+            waitForChain(name,chain,entry['activity'])
+    return errors
+
+def waitForChain(name, chain, activity):
+    try:
         try:
-            if twitter is not None:
-                    
-                logger.info("Getting Ready to make a tweet. How exciting!")
-                status = strava.makeTwitterString(athlete_year_stats=content[year],latest_event=activity)
-                
-                if status is not None:
-                    logging.info(status)
-                    if ("photos" in activity and 
-                        "primary" in activity['photos'] and 
-                        activity['photos']['primary'] is not None and 
-                        "urls" in activity['photos']['primary'] and 
-                        "600" in activity['photos']['primary']['urls']):
-                            
-                            image = requests.get(activity['photos']['primary']['urls']['600'])
-                            if image.status_code == 200:
-                                try:
-                                    photo = BytesIO(image.content)
-                                    twitterImage = twitter.upload_media(media=photo)
-                                except Exception as e:
-                                    logger.error("Failed to upload media from {} to twitter".format(activity['photos']['primary']['urls']['600']))
-                                    logger.error(e)
-                                    logger.error("Bailing on trying to use media, and now just tweeting the status without media")
-                                    if not debug:
-                                        twitter.update_status(status=status)
-                                else:
-                                    if not debug:
-                                      twitter.update_status(status=status, media_ids=[twitterImage['media_id']])
-                            else:
-                              if not debug:
-                                twitter.update_status(status=status)
-                    else:
-                      if not debug:
-                        twitter.update_status(status=status)
-                    logging.info("Tweet published")
-                else:
-                    logging.info("Not tweeting this time... nothing special!")
+            chain.result(timeout=STAGE_TIMEOUTS[name])
+        except FutureTimeout:
+            # Lambda freezes the container as soon as we return, so a chain left running would
+            # only carry on during some later invocation, if ever; see it through instead
+            logger.error("The {NAME} for activity {ID} is taking too long; still waiting for it".format(NAME=name,ID=activity['id']))
+            chain.result()
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        logger.error("The {NAME} for activity {ID} failed".format(NAME=name,ID=activity['id']))
+
+def getIOPool():
+    # A pool of its own for the per-activity chains, kept for the life of the container. It's
+    # separate from the per-athlete workers, which wait on it, so they can never starve it.
+    return getPool('ioWorkers',IO_WORKERS)
+
+def getFetchPool():
+    # The claims and fetches get another, as the chains can sit on their threads for a minute
+    # waiting for totals or an earlier tweet
+    return getPool('fetchWorkers',FETCH_WORKERS)
+
+def getPool(setting, default):
+    if setting not in pools:
+        with pools_lock:
+            if setting not in pools:
+                pools[setting] = ThreadPoolExecutor(max_workers=max(1,Utils.getEnvInt(setting,default)))
+    return pools[setting]
+
+def tweetChain(strava, activity, totals, debug, previous=None, counted=None):
+    # build a string to tweet
+    photo = None
+    if not activity.get('private', False):
+        photo = getPhoto(activity)
+    
+    logger.info("Getting Ready to make a tweet. How exciting!")
+    athlete_year_stats = totals.result(timeout=STAGE_TIMEOUTS['totals'])
+    if counted is not None and not counted.result():
+        # The delivery that counted it may well have tweeted it too; better none than two
+        logging.info("Not tweeting activity {ID}, it was counted by an earlier delivery".format(ID=activity['id']))
+        return
+    status = strava.makeTwitterString(athlete_year_stats=athlete_year_stats,latest_event=activity)
+    
+    if status is None:
+        logging.info("Not tweeting this time... nothing special!")
+        return
+    logging.info(status)
+    twitter = getTwitterClient()
+    media_ids = None
+    if photo is not None:
+        try:
+            with metrics.span("Twitter","upload_media"):
+                media_ids = [twitter.upload_media(media=photo)['media_id']]
         except Exception as e:
-            logger.error(traceback.format_exc())
-            logger.error("Failed to post the tweet. Bailing.")
-        #Update the activity description
+            logger.error("Failed to upload media from {} to twitter".format(activity['photos']['primary']['urls']['600']))
+            logger.error(e)
+            logger.error("Bailing on trying to use media, and now just tweeting the status without media")
+    if previous is not None:
+        # Wait for the tweet before this one; its failure is reported by whoever waits on it
         try:
-            spotifyliststring = None
-            if hasattr(strava,"spotify"):
-                spotifyliststring = getSpotifyTrackList(strava.spotify,activity['start_date'])
-                
-            result = strava.updateActivityDescription(athlete_year_stats=content[year],latest_event=activity,spotifytracks=spotifyliststring)
+            previous.result(timeout=STAGE_TIMEOUTS['tweet'])
         except Exception as e:
-            logger.error(traceback.format_exc())
-            logger.error("Failed to update activity {ID} description; trying to continue.".format(ID=activity['id']))
-            
-            result = strava.updateActivityDescription(athlete_year_stats=content[year],latest_event=activity)
-        except TwythonAuthError as e:
-            logger.error(traceback.format_exc())
-            logger.error("Failed to update activity {ID} description; trying to continue.".format(ID=activity['id']))
-            
-            result = strava.updateActivityDescription(athlete_year_stats=content[year],latest_event=activity)
-            
-        else:
-            if result:
-                logger.info("Strava activity description updated.".format(ID=recordjson['object_id']))
+            pass
+    if not debug:
+        with metrics.span("Twitter","update_status"):
+            if media_ids is not None:
+                twitter.update_status(status=status, media_ids=media_ids)
             else:
-                logger.info("Strava activity description not updated.".format(ID=recordjson['object_id']))
-                
-    logging.info("Profit!")
+                twitter.update_status(status=status)
+    logging.info("Tweet published")
 
-def getTwitterClient():
-    if Utils.getEnv("ssmPrefix") is not None:
-        client = Twython(
-                    Utils.getSSM("TwitterConsumerKey"), 
-                    Utils.getSSM("TwitterConsumerSecret"),
-                    Utils.getSSM("TwitterAccessTokenKey"), 
-                    Utils.getSSM("TwitterAccessTokenSecret"))
-        return client
-    else:
-        print("No twitter credentials found, so passing")
+def getPhoto(activity):
+    if ("photos" in activity and 
+        "primary" in activity['photos'] and 
+        activity['photos']['primary'] is not None and 
+        "urls" in activity['photos']['primary'] and 
+        "600" in activity['photos']['primary']['urls']):
+        try:
+            with metrics.span("Photos","GET") as span:
+                image = Utils.getHttpSession().get(activity['photos']['primary']['urls']['600'],timeout=STAGE_TIMEOUTS['photo'])
+                span.status = image.status_code
+        except Exception as e:
+            logger.error("Failed to download the photo for activity {}".format(activity['id']))
+            logger.error(e)
+            return None
+        if image.status_code == 200:
+            return BytesIO(image.content)
     return None
+
+def descriptionChain(strava, activity, totals):
+    #Update the activity description
+    spotifyliststring = None
+    if hasattr(strava,"spotify"):
+        spotifyliststring = getSpotifyTrackList(strava.spotify,activity['start_date'])
+    
+    athlete_year_stats = totals.result(timeout=STAGE_TIMEOUTS['totals'])
+    try:
+        result = strava.updateActivityDescription(athlete_year_stats=athlete_year_stats,latest_event=activity,spotifytracks=spotifyliststring)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        logger.error("Failed to update activity {ID} description; trying to continue.".format(ID=activity['id']))
+        
+        result = strava.updateActivityDescription(athlete_year_stats=athlete_year_stats,latest_event=activity)
+        
+    if result:
+        logger.info("Strava activity description updated.")
+    else:
+        logger.info("Strava activity description not updated.")
+
+def tweetsEnabled():
+    if Utils.getEnv("ssmPrefix") is not None:
+        return True
+    print("No twitter credentials found, so passing")
+    return False
+
+def getTwitterClient():
+    # Only called once a tweet is ready to go, so batches with nothing to tweet never import
+    # twython or look up the credentials
+    global twitter_client
+    with twitter_lock:
+        if twitter_client is None:
+            from twython import Twython
+            twitter_client = Twython(
+                        Utils.getSSM("TwitterConsumerKey"), 
+                        Utils.getSSM("TwitterConsumerSecret"),
+                        Utils.getSSM("TwitterAccessTokenKey"), 
+                        Utils.getSSM("TwitterAccessTokenSecret"))
+        return twitter_client
     
 def getSpotifyTrackList(tokens,start_date):
     try:
         spotify_string = None
         logger.debug("Making Spotify client")
+        import spotipy
+        from spotipy.oauth2 import SpotifyClientCredentials
         client = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(client_id = tokens['client_id'],client_secret = tokens['client_secret']))
         logger.debug("Making time as msecs")
         dt_msecs = datetime.strptime(start_date,'%Y-%m-%dT%H:%M:%SZ').timestamp() * 1000
         logger.debug("Getting track listing from Spotify")
-        track_list = client.current_user_recently_played(limit=50, after=dt_msecs)
-        logger.info(track_list)
+        with metrics.span("Spotify","current_user_recently_played"):
+            track_list = client.current_user_recently_played(limit=50, after=dt_msecs)
+        Utils.logPayload("Spotify tracks",track_list)
         if len(track_list) >0:
             spotify_string = "I listened to the following tracks:\n"
             logger.debug("Building tracklist")
@@ -0,0 +1,155 @@
+import unittest
+import os
+import sys
+import importlib.util
+
+from unittest.mock import patch
+
+# The handler imports the layer as plain `strava`, the way Lambda lays it out
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "layers", "strava", "src", "python"))
+spec = importlib.util.spec_from_file_location("daily_index", os.path.join(ROOT, "src", "daily", "index.py"))
+daily = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(daily)
+
+class FakeStrava(object):
+  # Stands in for Strava(athleteId=...) in a reset, keeping its item in athletes
+  athletes = {}
+  deferOn = set()
+  unreadable = set()
+  refreshed = []
+  built = []
+
+  def __init__(self, athleteId, stravaClientId=None, stravaClientSecret=None):
+    if athleteId in self.unreadable:
+      raise ConnectionError("DynamoDB is having a bad day")
+    self.athleteId = athleteId
+    self.athlete = self.athletes.get(athleteId)
+
+  def refreshTokens(self, margin=None):
+    self.refreshed.append(self.athleteId)
+
+  def buildTotals(self):
+    if self.athleteId in self.deferOn:
+      raise daily.RateLimitDeferred("Strava's budget is low")
+    self.built.append(self.athleteId)
+
+  def markReset(self, resetRun):
+    self.athlete['last_reset_run'] = resetRun
+
+class Context(object):
+  def __init__(self, remaining=600000, requestId="r1"):
+    self.remaining = remaining
+    self.aws_request_id = requestId
+
+  def get_remaining_time_in_millis(self):
+    return self.remaining
+
+class TestReset(unittest.TestCase):
+  def setUp(self):
+    FakeStrava.athletes = {athleteId: {"Id": athleteId} for athleteId in ["1", "2", "3", "4"]}
+    FakeStrava.deferOn = set()
+    FakeStrava.unreadable = set()
+    FakeStrava.refreshed = []
+    FakeStrava.built = []
+    patcher = patch.object(daily, 'Strava', FakeStrava)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_deferralStopsTheRun(self):
+    FakeStrava.deferOn = {"2"}
+    result = daily.resetAthletes(["1", "2", "3", "4"], "run", 1, "id", "secret", Context())
+    self.assertEqual(result, {"done": ["1"], "skipped": [], "remaining": ["2", "3", "4"]})
+    self.assertEqual(FakeStrava.built, ["1"])
+    # Re-invoked with the same run id, it picks up where it stopped
+    FakeStrava.deferOn = set()
+    result = daily.resetAthletes(["1", "2", "3", "4"], "run", 1, "id", "secret", Context())
+    self.assertEqual(result, {"done": ["2", "3", "4"], "skipped": ["1"], "remaining": []})
+
+  def test_outOfTimeStartsNothing(self):
+    result = daily.resetAthletes(["1", "2"], "run", 2, "id", "secret", Context(remaining=daily.RESET_TIME_MARGIN-1))
+    self.assertEqual(result['remaining'], ["1", "2"])
+    # Not even the token refreshes, which now happen inside the time budget
+    self.assertEqual(FakeStrava.refreshed, [])
+
+  @patch.object(daily.Utils, 'getSSM', return_value="x")
+  @patch.object(daily.Utils, 'flushMetrics')
+  def test_rerunOnTheSameDayResetsAgain(self, flushMetrics, getSSM):
+    first = daily.lambda_handler({"reset": ["1", "2"]}, Context(requestId="r1"))
+    second = daily.lambda_handler({"reset": ["1", "2"]}, Context(requestId="r2"))
+    self.assertEqual((first['done'], second['done']), (["1", "2"], ["1", "2"]))
+    self.assertNotEqual(first['resetRun'], second['resetRun'])
+    # Passing the run id back resumes it instead
+    resumed = daily.lambda_handler({"reset": ["1", "2"], "resetRun": second['resetRun']}, Context(requestId="r3"))
+    self.assertEqual(resumed['skipped'], ["1", "2"])
+    self.assertEqual(sorted(FakeStrava.refreshed), ["1", "1", "2", "2"])
+    # Lambda retrying the same event keeps its request id, and so resumes the run
+    retried = daily.lambda_handler({"reset": ["1", "2"]}, Context(requestId="r2"))
+    self.assertEqual((retried['resetRun'], retried['skipped']), (second['resetRun'], ["1", "2"]))
+
+  def test_unreadableAthleteIsLeftForLater(self):
+    FakeStrava.unreadable = {"2"}
+    result = daily.resetAthletes(["1", "2", "3"], "run", 2, "id", "secret", Context())
+    self.assertEqual(result, {"done": ["1", "3"], "skipped": [], "remaining": ["2"]})
+
+class FakeWorksheet(object):
+  def __init__(self, rows):
+    self.rows = rows
+    self.updates = []
+    self.inserted = []
+
+  def get_all_values(self):
+    return [list(row) for row in self.rows]
+
+  def batch_update(self, updates, value_input_option=None):
+    self.updates.extend(updates)
+
+  def insert_rows(self, rows, row=1, value_input_option=None):
+    self.inserted.append((row, rows))
+
+class SheetAthlete(object):
+  totals = {}
+  profiles = {}
+
+  def __init__(self, athleteId, stravaClientId=None, stravaClientSecret=None):
+    self.athleteId = athleteId
+    self.athlete = {"Id": athleteId} if athleteId in self.totals else None
+
+  def getTotals(self):
+    return self.totals.get(self.athleteId, {})
+
+  def getProfile(self):
+    return self.profiles[self.athleteId]
+
+class TestSyncSheet(unittest.TestCase):
+  def test_updatesExistingRowsAndAppendsNewOnes(self):
+    SheetAthlete.totals = {
+      "1": {"2026": {"Run": {"distance": 16093.4, "duration": 3600, "count": 2}}},
+      "2": {"2026": {"Run": {"distance": 1609.34, "duration": 600, "count": 1}}},
+      "3": {"2026": {"Run": {"distance": 3218.68, "duration": 1200, "count": 1}}},
+      "4": {"2025": {"Run": {"distance": 1609.34, "duration": 600, "count": 1}}},
+      "5": {}
+      }
+    SheetAthlete.profiles = {"3": {"firstname": "Ada", "lastname": "Lovelace"}, "4": {"firstname": "New", "lastname": "Runner"}, "5": {"firstname": "Yet", "lastname": "To Start"}}
+    worksheet = FakeWorksheet([
+      ["Id", "Name", "Jan", "Feb", "Mar"],
+      ["1", "Existing Runner", "5", "9", ""],
+      ["2", "Unchanged Runner", "0", "0", "1.0"],
+      ["", "Ada Lovelace", "", "", ""],
+      ["", "", "", "", "Totals"]
+      ])
+    with patch.object(daily, 'Strava', SheetAthlete):
+      result = daily.syncSheet(worksheet, ["1", "2", "3", "4", "5", "6"], "2026", 3, "id", "secret")
+    self.assertEqual(result, {"updated": 3, "added": 2})
+    # Only the cells that changed are written, including the Id of the row matched by name
+    self.assertEqual([update['range'] for update in worksheet.updates], ["E2", "A4", "E4"])
+    self.assertAlmostEqual(worksheet.updates[0]['values'][0][0], 10.0)
+    self.assertEqual(worksheet.updates[1]['values'], [["3"]])
+    self.assertAlmostEqual(worksheet.updates[2]['values'][0][0], 2.0)
+    # New athletes go after the last named row, with zeros up to this month, even with nothing
+    # logged yet; 6 isn't registered at all
+    self.assertEqual(worksheet.inserted, [(5, [["4", "New Runner", 0, 0, 0], ["5", "Yet To Start", 0, 0, 0]])])
+    self.assertEqual(daily.cellName(3, 28), "AB3")
+
+if __name__ == '__main__':
+  unittest.main()
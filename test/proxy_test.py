@@ -1,21 +1,69 @@
 import unittest
 import json
 import os
+import sys
+import importlib.util
 
 from unittest import mock
+from unittest.mock import patch
+
+# The handler imports the layer as plain `strava`, the way Lambda lays it out
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "layers", "strava", "src", "python"))
+spec = importlib.util.spec_from_file_location("proxy_index", os.path.join(ROOT, "src", "proxy", "index.py"))
+proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(proxy)
+
+QUEUE = "https://sqs.eu-west-1.amazonaws.com/123456789012/events"
+
+class Context(object):
+  invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:proxy"
+
+def webhookEvent(method, body=None, query=None):
+  event = {"rawPath": "/webhook/", "requestContext": {"http": {"method": method}}}
+  if body is not None:
+    event['body'] = json.dumps(body)
+  if query is not None:
+    event['queryStringParameters'] = query
+  return event
 
 class TestProxy(unittest.TestCase):
-    
-    @unittest.skip('Not ready yet')
-    def test_register_redirect(self):
-        stream = os.popen('sam local invoke ProxyLambdaFunction -e test/payloads/register_test.json 2> /dev/null')
-        output = stream.read()
-        stream.close
-        print("START{}END".format(output))
-        self.assertIsNotNone(output)
-        expectation={"statusCode": 301, "headers": {"Location": "https://www.strava.com/oauth/authorize?client_id=pStravaClientId&redirect_uri=https://abcde123456.execute-api.eu-west-1.amazonaws.com/registersuccess/&response_type=code&scope=activity:read_all,activity:write"}, "body": ""}
-
-        self.assertEqual(json.loads(output),expectation)
+  def setUp(self):
+    self.clients = {"sqs": mock.Mock()}
+    for patcher in [patch.object(proxy.aws, 'client', side_effect=lambda service: self.clients[service]),
+                    patch.object(proxy.Utils, 'flushMetrics'),
+                    patch.dict(os.environ, {"sqsUrl": QUEUE})]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def test_newActivityIsQueued(self):
+    body = {"object_type": "activity", "aspect_type": "create", "object_id": 101, "owner_id": 1, "subscription_id": 1}
+    event = webhookEvent("POST", body)
+    response = proxy.lambda_handler(event, Context())
+    self.assertEqual(response['statusCode'], 200)
+    self.clients['sqs'].send_message.assert_called_once_with(QueueUrl=QUEUE, MessageBody=event['body'])
+
+  def test_otherEventsAreAcknowledgedButNotQueued(self):
+    response = proxy.lambda_handler(webhookEvent("POST", {"object_type": "activity", "aspect_type": "update", "object_id": 101, "owner_id": 1}), Context())
+    self.assertEqual(response['statusCode'], 200)
+    self.clients['sqs'].send_message.assert_not_called()
+
+  def test_verifyTokenIsTheAccountNumber(self):
+    response = proxy.lambda_handler(webhookEvent("GET", query={"hub.challenge": "abc", "hub.verify_token": "123456789012"}), Context())
+    self.assertEqual((response['statusCode'], json.loads(response['body'])), (200, {"hub.challenge": "abc"}))
+    response = proxy.lambda_handler(webhookEvent("GET", query={"hub.challenge": "abc", "hub.verify_token": "999999999999"}), Context())
+    self.assertEqual(response['statusCode'], 403)
+
+  @unittest.skip('Not ready yet')
+  def test_register_redirect(self):
+    stream = os.popen('sam local invoke ProxyLambdaFunction -e test/payloads/register_test.json 2> /dev/null')
+    output = stream.read()
+    stream.close
+    print("START{}END".format(output))
+    self.assertIsNotNone(output)
+    expectation={"statusCode": 301, "headers": {"Location": "https://www.strava.com/oauth/authorize?client_id=pStravaClientId&redirect_uri=https://abcde123456.execute-api.eu-west-1.amazonaws.com/registersuccess/&response_type=code&scope=activity:read_all,activity:write"}, "body": ""}
+
+    self.assertEqual(json.loads(output),expectation)
         
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()    
@@ -1,11 +1,26 @@
 import unittest
+import logging
 import json
+import random
+import time
+import datetime
+from decimal import Decimal
 
 from src.layers.strava.src.python.strava import Strava
 from src.layers.strava.src.python.strava import Utils
+from src.layers.strava.src.python.strava import ParameterCache
+from src.layers.strava.src.python.strava import RateBudget
+from src.layers.strava.src.python.strava import MemoryRateStore
+from src.layers.strava.src.python.strava import RateLimitDeferred
+from src.layers.strava.src.python.strava import AWSRegistry
+from src.layers.strava.src.python.strava import TokenManager
+from src.layers.strava.src.python.strava import Metrics
+from src.layers.strava.src.python.strava import PayloadLog
 
 
 from unittest import mock
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 class TestStrava(unittest.TestCase):
@@ -62,8 +77,8 @@ class TestStrava(unittest.TestCase):
   @patch('src.layers.strava.src.python.strava.Strava.getCurrentAthlete')
   def test_makeTwitterStatus(self,getCurrentAthlete,getAthleteFromDDB,getSSM,getEnv):
     tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
-    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
-    getCurrentAthlete.return_value = {"firstname": "Jonathan", "lastname": "Jenkyn"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens), "profile": json.dumps({"firstname": "Jonathan", "lastname": "Jenkyn"}), "profileFetched": Decimal(int(time.time()))}
+    getCurrentAthlete.return_value = {"firstname": "Someone", "lastname": "Else"}
     getSSM.return_value = "DEADBEEF"
     getEnv.return_value = "1234"
     with open('test/payloads/ddb_body.json') as json_file:
@@ -79,6 +94,8 @@ class TestStrava(unittest.TestCase):
     self.assertIn("🤩",twitterString)
     self.assertIn("💨",twitterString)
     self.assertIn("⏱️",twitterString)
+    # The name comes from the cached profile, without asking Strava
+    getCurrentAthlete.assert_not_called()
   
   @patch('src.layers.strava.src.python.strava.Utils.getEnv')
   @patch('src.layers.strava.src.python.strava.Utils.getSSM')
@@ -86,8 +103,8 @@ class TestStrava(unittest.TestCase):
   @patch('src.layers.strava.src.python.strava.Strava.getCurrentAthlete')
   def test_makeTwitterStatusWithZwift(self,getCurrentAthlete,getAthleteFromDDB,getSSM,getEnv):
     tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
-    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
-    getCurrentAthlete.return_value = {"firstname": "Jonathan", "lastname": "Jenkyn"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens), "profile": json.dumps({"firstname": "Jonathan", "lastname": "Jenkyn"}), "profileFetched": Decimal(int(time.time()))}
+    getCurrentAthlete.return_value = {"firstname": "Someone", "lastname": "Else"}
     getSSM.return_value = "DEADBEEF"
     getEnv.return_value = "1234"
     with open('test/payloads/ddb_body.json') as json_file:
@@ -118,6 +135,525 @@ class TestStrava(unittest.TestCase):
       self.assertEqual(strava.getEffortQ({'average_heartrate':120,'moving_time':60*60}),(129600 / (4*24*60*60)) * 100.0)
       self.assertEqual(strava.getEffortQ({'average_heartrate':180,'moving_time':60*60*3}),(345600 / (4*24*60*60)) * 100.0)
 
-  
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.getSSMClient')
+  def test_parameterCache(self,getSSMClient,getEnv):
+    getEnv.return_value = "p"
+    ssm = getSSMClient.return_value
+    ssm.get_parameters.return_value = {"Parameters": [{"Name": "pStravaClientId", "Value": "1234"}], "InvalidParameters": ["pStravaClubId"]}
+    cache = ParameterCache(ttl=300)
+    self.assertEqual(cache.get("StravaClientId"),"1234")
+    self.assertIsNone(cache.get("StravaClubId"))
+    self.assertEqual(cache.get("StravaClientId"),"1234")
+    self.assertEqual(ssm.get_parameters.call_count,1)
+    ssm.get_parameter.assert_not_called()
+    self.assertEqual(cache.stats()['hits'],2)
+    self.assertEqual(cache.stats()['misses'],1)
+    cache.invalidate()
+    cache.get("StravaClientId")
+    self.assertEqual(ssm.get_parameters.call_count,2)
+    cache.ttl = -1
+    cache.get("StravaClientId")
+    self.assertEqual(ssm.get_parameters.call_count,3)
+  def test_httpSessionIsShared(self):
+    session = Utils.getHttpSession()
+    self.assertIs(session,Utils.getHttpSession())
+    self.assertIn("gzip",session.headers['Accept-Encoding'])
+    self.assertEqual(session.get_adapter("https://www.strava.com")._pool_maxsize,10)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._getDetailActivity')
+  @patch('src.layers.strava.src.python.strava.Strava._get')
+  def test_getActivityIsCached(self,get,getDetailActivity,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    getDetailActivity.return_value = None
+    get.return_value = {"id": 42, "type": "VirtualRide", "resource_state": 3}
+    Strava.clearActivityCache()
+    strava=Strava(athleteId = 1234567)
+    activity = strava.getActivity(42)
+    activity['type'] = "Ride"
+    self.assertEqual(strava.getActivity(42)['type'],"VirtualRide")
+    self.assertEqual(get.call_count,1)
+    # An event newer than our copy means the activity has changed, so go back to Strava
+    strava.getActivity(42,notBefore=time.time()+60)
+    self.assertEqual(get.call_count,2)
+    Strava.clearActivityCache()
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava.refreshTokens')
+  @patch('src.layers.strava.src.python.strava.Strava._get')
+  def test_getActivitiesSincePagesInParallel(self,get,refreshTokens,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    sizes = {1: 200, 2: 200, 3: 5}
+    def page(endpoint,deferrable=False):
+      number = int(endpoint.split("page=")[1].split("&")[0])
+      return [{"id": number*1000+i, "start_date": "2022-01-01T00:{:02}:{:02}Z".format(number,i%60)} for i in range(sizes.get(number,0))]
+    get.side_effect = page
+    strava=Strava(athleteId = 1234567)
+    activities = strava.getActivitiesSince(0,workers=3)
+    self.assertEqual(len(activities),405)
+    self.assertEqual(activities,sorted(activities,key=lambda a: (a['start_date'],a['id'])))
+    self.assertEqual(get.call_count,4)
+    # A page that fails part way through stops the whole fetch rather than looking like the last one
+    sizes[3] = 200
+    get.side_effect = lambda endpoint,deferrable=False: {} if "page=3&" in endpoint else page(endpoint,deferrable)
+    with self.assertRaises(ConnectionError):
+      strava.getActivitiesSince(0,workers=3)
+  @patch('src.layers.strava.src.python.strava.time.sleep')
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_putDetailActivities(self,getAthleteFromDDB,getSSM,getEnv,sleep):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    strava.ddbDetailTable = mock.Mock()
+    strava.ddbDetailTable.name = "Details"
+    strava.dynamodb = mock.Mock()
+    strava.dynamodb.batch_get_item.return_value = {"Responses": {"Details": [{"activityId": 1}]}, "UnprocessedKeys": {}}
+    unprocessed = {"Details": [{"PutRequest": {"Item": {"activityId": 2}}}]}
+    strava.dynamodb.batch_write_item.side_effect = [{"UnprocessedItems": unprocessed}] + [{"UnprocessedItems": {}}] * 2
+    activities = [{"id": i, "type": "Run", "distance": 5000.0, "moving_time": 1500, "start_date": "2022-01-01T00:00:00Z"} for i in range(1,31)]
+    result = strava.putDetailActivities(activities)
+    self.assertNotIn(1,result['new'])
+    self.assertIn(2,result['new'])
+    self.assertEqual(len(result['new']),29)
+    self.assertEqual(len(result['failed']),0)
+    self.assertEqual(strava.dynamodb.batch_write_item.call_count,3)
+    self.assertEqual(len(strava.dynamodb.batch_write_item.call_args_list[0][1]['RequestItems']['Details']),25)
+  def test_rateBudget(self):
+    store = MemoryRateStore()
+    budget = RateBudget(store=store,reserve=0.2,maxWait=0)
+    budget.record({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "50,300", "X-ReadRateLimit-Limit": "50,500", "X-ReadRateLimit-Usage": "45,100"})
+    self.assertEqual(store.read()['usage15'],45)
+    self.assertEqual(store.read()['limit15'],50)
+    self.assertEqual(store.read()['usageDay'],300)
+    # Live traffic is never held back, deferrable work is
+    budget.acquire(deferrable=False)
+    with self.assertRaises(RateLimitDeferred):
+      budget.acquire(deferrable=True)
+    # Another container's fresher view is picked up from the shared store
+    store.write(dict(store.read(),usage15=10,limit15=100,updated=store.read()['updated']+1))
+    budget.synced = 0
+    budget.acquire(deferrable=True)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.aws',new_callable=AWSRegistry)
+  @patch('src.layers.strava.src.python.strava.boto3.client')
+  def test_iterAthleteIdsFollowsEverySegment(self,client,aws,getEnv):
+    getEnv.return_value = "Totals"
+    def scan(**args):
+      if "ExclusiveStartKey" not in args:
+        return {"Items": [{"Id": {"S": "{}a".format(args['Segment'])}}], "LastEvaluatedKey": {"Id": {"S": "x"}}}
+      return {"Items": [{"Id": {"S": "{}b".format(args['Segment'])}}]}
+    client.return_value.scan.side_effect = scan
+    ids = sorted(Utils.iterAthleteIds(segments=3))
+    self.assertEqual(ids,["0a","0b","1a","1b","2a","2b"])
+    self.assertEqual(client.return_value.scan.call_count,6)
+  def test_totalsAttributesRoundTrip(self):
+    with open('test/payloads/ddb_body.json') as json_file:
+      body = json.load(json_file)
+    attributes = Utils.totalsToAttributes(body)
+    self.assertEqual(attributes["totals:2022:Ride:count"],60)
+    item = {"Id": "1234567", "body": "{}"}
+    item.update({name: Decimal(value) for name, value in attributes.items()})
+    self.assertEqual(Utils.totalsFromItem(item),body)
+    self.assertEqual(Utils.totalsFromItem({"Id": "1234567", "body": json.dumps(body)}),body)
+
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_addToTotalsIsOneAtomicUpdate(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    year = str(datetime.datetime.now().year)
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens), "totals:{}:Run:count".format(year): Decimal(1)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    strava.ddbTable = mock.Mock()
+    strava.ddbTable.update_item.return_value = {"Attributes": {
+      "totals:{}:Run:distance".format(year): Decimal(10000),
+      "totals:{}:Run:duration".format(year): Decimal(3600),
+      "totals:{}:Run:count".format(year): Decimal(2)}}
+    totals = strava.addToTotals("Run",5000.4,1800,activityId=99)
+    self.assertEqual(totals,{year: {"Run": {"distance": 10000, "duration": 3600, "count": 2}}})
+    self.assertEqual(strava.ddbTable.update_item.call_count,1)
+    args = strava.ddbTable.update_item.call_args[1]
+    self.assertTrue(args['UpdateExpression'].startswith("ADD "))
+    self.assertIn("SET last_activity_id=:id",args['UpdateExpression'])
+    self.assertEqual(args['ExpressionAttributeValues'][':distance'],5000)
+    self.assertEqual(args['ReturnValues'],"ALL_NEW")
+
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_addActivitiesToTotalsIsOneWrite(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    year = str(datetime.datetime.now().year)
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    strava.ddbTable = mock.Mock()
+    strava.ddbTable.update_item.return_value = {"Attributes": {
+      "totals:{}:Run:distance".format(year): Decimal(15000),
+      "totals:{}:Run:duration".format(year): Decimal(5400),
+      "totals:{}:Run:count".format(year): Decimal(3),
+      "totals:{}:Yoga:distance".format(year): Decimal(0),
+      "totals:{}:Yoga:duration".format(year): Decimal(600),
+      "totals:{}:Yoga:count".format(year): Decimal(1)}}
+    activities = [("Run",5000.4,1800),("Yoga",0,600),("Run",4000,1200)]
+    totals = strava.addActivitiesToTotals(activities,activityId=99)
+    self.assertEqual(strava.ddbTable.update_item.call_count,1)
+    args = strava.ddbTable.update_item.call_args[1]
+    self.assertEqual((args['ExpressionAttributeValues'][':distance'],args['ExpressionAttributeValues'][':count']),(9000,2))
+    self.assertEqual(args['ExpressionAttributeNames']['#duration1'],"totals:{}:Yoga:duration".format(year))
+    # Each activity's own view of the year leaves out the ones after it
+    self.assertEqual(Utils.totalsBefore(totals[year],activities[1:]),{"Run": {"distance": 11000, "duration": 4200, "count": 2}})
+    self.assertEqual(Utils.totalsBefore(totals[year],activities[2:]),{"Run": {"distance": 11000, "duration": 4200, "count": 2}, "Yoga": {"distance": 0, "duration": 600, "count": 1}})
+    self.assertEqual(Utils.totalsBefore(totals[year],[]),totals[year])
+
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_countActivitiesSkipsOnesAlreadyCounted(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    year = str(datetime.datetime.now().year)
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    strava=Strava(athleteId = 1234567)
+    # 101 was counted by an earlier delivery, so the first write is refused
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens), "counted_activities": set([Decimal(101)])}
+    strava.ddbTable = mock.Mock()
+    strava.ddbTable.update_item.side_effect = [
+      ClientError({"Error": {"Code": "ConditionalCheckFailedException"}},"UpdateItem"),
+      {"Attributes": {"totals:{}:Run:distance".format(year): Decimal(9000), "totals:{}:Run:duration".format(year): Decimal(3000), "totals:{}:Run:count".format(year): Decimal(2)}}]
+    totals, counted = strava.countActivities([(101,"Run",5000,1800),(102,"Run",4000,1200)],activityId=102)
+    self.assertEqual(counted,[102])
+    self.assertEqual(totals[year]["Run"]["count"],2)
+    first, second = [call[1] for call in strava.ddbTable.update_item.call_args_list]
+    self.assertEqual(first['ConditionExpression'],"NOT contains(counted_activities, :c0) AND NOT contains(counted_activities, :c1)")
+    self.assertEqual(second['ExpressionAttributeValues'][':counted'],set([102]))
+    self.assertEqual(second['ExpressionAttributeValues'][':distance'],4000)
+    self.assertIn("counted_activities :counted",second['UpdateExpression'])
+
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_replaceTotalsKeepsOtherYears(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    with open('test/payloads/ddb_body.json') as json_file:
+      body = json.load(json_file)
+    getAthleteFromDDB.return_value = {"Id": "1234567", "tokens": json.dumps(tokens), "body": json.dumps(body)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    strava.ddbTable = mock.Mock()
+    strava.ddbTable.update_item.return_value = {"Attributes": {}}
+    strava._replaceTotals({"2022": {"Run": {"distance": 5000, "duration": 1500, "count": 1}}},["2022"])
+    args = strava.ddbTable.update_item.call_args[1]
+    written = {args['ExpressionAttributeNames'][key.replace(":","#")]: value for key, value in args['ExpressionAttributeValues'].items() if key.startswith(":a")}
+    self.assertEqual(written["totals:2022:Run:count"],1)
+    self.assertNotIn("totals:2022:Walk:count",written)
+    self.assertEqual(written["totals:2021:Walk:count"],73)
+    self.assertIn("body",args['ExpressionAttributeNames'].values())
+    self.assertEqual(args['ExpressionAttributeValues'][':years'],{"2021","2022"})
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._replaceTotals')
+  @patch('src.layers.strava.src.python.strava.Strava.refreshTokens')
+  @patch('src.layers.strava.src.python.strava.Strava._get')
+  def test_failedPageLeavesTotalsAlone(self,get,refreshTokens,replaceTotals,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    # What _get hands back for a 5xx, a timeout or a 429 it can't defer
+    get.return_value = {}
+    strava=Strava(athleteId = 1234567)
+    strava.ddbDetailTable = mock.Mock()
+    strava.ddbDetailTable.query.return_value = {"Items": []}
+    with self.assertRaises(ConnectionError):
+      strava.buildTotals()
+    with self.assertRaises(ConnectionError):
+      strava.recomputeTotals()
+    replaceTotals.assert_not_called()
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._replaceTotals')
+  @patch('src.layers.strava.src.python.strava.Strava.putDetailActivities')
+  @patch('src.layers.strava.src.python.strava.Strava.getActivitiesSince')
+  def test_recomputeTotalsFromDetails(self,getActivitiesSince,putDetailActivities,replaceTotals,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    year = str(datetime.datetime.now().year)
+    start = int(datetime.datetime(int(year),1,1,0,0).timestamp())
+    strava=Strava(athleteId = 1234567)
+    strava.ddbDetailTable = mock.Mock()
+    strava.ddbDetailTable.name = "Details"
+    strava.ddbDetailTable.query.side_effect = [
+      {"Items": [{"activityId": Decimal(1), "eventEpoch": Decimal(start+100), "activityType": "Run", "distance": Decimal("5000.5"), "moving_time": Decimal(1500)}], "LastEvaluatedKey": {"activityId": 1}},
+      {"Items": [{"activityId": Decimal(2), "eventEpoch": Decimal(start+200)}]}]
+    strava.dynamodb = mock.Mock()
+    strava.dynamodb.batch_get_item.return_value = {"Responses": {"Details": [{"activityId": 2, "event": json.dumps({"type": "Run", "distance": 3000, "moving_time": 900, "start_date": "{}-01-01T12:00:00Z".format(year)})}]}}
+    getActivitiesSince.return_value = [{"id": 2, "type": "Run"}, {"id": 3, "type": "VirtualRide", "distance": 20000, "moving_time": 2400, "start_date": "{}-01-02T00:00:00Z".format(year)}]
+    putDetailActivities.return_value = {"new": {3}, "failed": set()}
+    strava.recomputeTotals()
+    self.assertEqual(strava.ddbDetailTable.query.call_count,2)
+    self.assertEqual(strava.ddbDetailTable.query.call_args[1]['IndexName'],"searchForAthleteInTimeRange")
+    self.assertEqual(getActivitiesSince.call_args[0][0],start+200)
+    content = replaceTotals.call_args[0][0]
+    self.assertEqual(content[year]["Run"]["count"],2)
+    self.assertEqual(content[year]["Run"]["duration"],2400)
+    self.assertEqual(content[year]["Ride"]["distance"],20000)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_aggregateTotalsMatchesUpdateContent(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    start = int(datetime.datetime(datetime.datetime.now().year,1,2,0,0).timestamp())
+    rng = random.Random(42)
+    types = [rng.choice(["Run","Ride","Walk","Yoga"]) for i in range(500)]
+    distances = [0 if t == "Yoga" else rng.uniform(1000,50000) for t in types]
+    durations = [rng.randint(600,10000) for t in types]
+    epochs = [start+i*3600 for i in range(len(types))]
+    content = {}
+    for activityType, distance, duration in zip(types,distances,durations):
+      content = strava.updateContent(content,activityType,distance,duration)
+    for aggregated in [Utils.aggregateTotals(types,distances,durations,epochs),Utils._aggregateTotalsLoop(types,distances,durations,epochs)]:
+      # Same shape, key order and types; the float distances agree to within rounding
+      self.assertEqual([(year,list(totals)) for year, totals in aggregated.items()],[(year,list(totals)) for year, totals in content.items()])
+      for year, totals in content.items():
+        for activityType, expected in totals.items():
+          self.assertAlmostEqual(aggregated[year][activityType]['distance'],expected['distance'],places=4)
+          self.assertEqual(aggregated[year][activityType]['duration'],expected['duration'])
+          self.assertEqual(aggregated[year][activityType]['count'],expected['count'])
+          self.assertEqual(type(aggregated[year][activityType]['distance']),type(expected['distance']))
+    self.assertEqual(Utils.aggregateTotals([],[],[],[]),{})
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_replayTags(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    activities = [{"id": i, "type": "Run", "distance": 10000, "moving_time": 3000, "start_date": "2022-01-{:02}T08:00:00Z".format(i)} for i in range(1,11)]
+    activities.append({"id": 11, "type": "VirtualRide", "distance": 20000, "moving_time": 3600, "start_date": "2023-01-01T08:00:00Z"})
+    random.shuffle(activities)
+    replayed = strava.replayTags(activities)
+    self.assertEqual([result['id'] for result in replayed],list(range(1,12)))
+    # First of the year for the type; no averages to compare against yet
+    self.assertEqual(replayed[0]['tags'],["💪"])
+    self.assertIn("🙌",replayed[9]['tags'])
+    self.assertIn("🔥",replayed[9]['tags'])
+    self.assertIn("🔟",replayed[9]['tags'])
+    # A new year starts from scratch
+    self.assertIn("💪",replayed[10]['tags'])
+    # The live path gives the same tags for the same totals
+    ytd = {"distance": 100000, "duration": 30000, "count": 10}
+    self.assertEqual(sorted(strava.getTags(activities[0],ytd,100000,30000,10)),sorted(strava._evaluateTags(activities[0],ytd,100000,30000,10)))
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._getDDBTable')
+  @patch('src.layers.strava.src.python.strava.Strava.getCurrentAthlete')
+  def test_getProfileRefreshesWhenStale(self,getCurrentAthlete,getDDBTable,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens), "profile": json.dumps({"firstname": "Old", "lastname": "Name"}), "profileFetched": Decimal(1)}
+    getCurrentAthlete.return_value = {"id": 1234567, "firstname": "Jonathan", "lastname": "Jenkyn", "bikes": [{"id": "b1"}]}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    self.assertEqual(strava.getProfile(),{"id": 1234567, "firstname": "Jonathan", "lastname": "Jenkyn"})
+    # Only the profile fields are kept, and the second call is served from the item
+    self.assertEqual(strava.getProfile(),{"id": 1234567, "firstname": "Jonathan", "lastname": "Jenkyn"})
+    self.assertEqual(getCurrentAthlete.call_count,1)
+    self.assertEqual(getDDBTable.return_value.update_item.call_count,1)
+    self.assertEqual(json.loads(getDDBTable.return_value.update_item.call_args.kwargs['ExpressionAttributeValues'][':p']),{"id": 1234567, "firstname": "Jonathan", "lastname": "Jenkyn"})
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._getDDBTable')
+  @patch('src.layers.strava.src.python.strava.Strava._getTokensWithCode')
+  @patch('src.layers.strava.src.python.strava.Strava.buildTotals')
+  def test_registerNewAthlete(self,buildTotals,getTokensWithCode,getDDBTable,getAthleteFromDDB,getSSM,getEnv):
+    getTokensWithCode.return_value = {"expires_at": int(time.time())+21600, "access_token": "abcdef1234567890", "refresh_token": "0987654321fedcba", "athlete": {"id": 7654321, "firstname": "Jonathan", "lastname": "Jenkyn"}}
+    getAthleteFromDDB.return_value = None
+    getSSM.side_effect = lambda name: None if name == "StravaClubId" else "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava = Strava(auth = "code")
+    self.assertEqual(strava.getRegistrationResult()['statusCode'],200)
+    self.assertEqual(getDDBTable.return_value.put_item.call_args.kwargs['Item']['Id'],"7654321")
+    self.assertEqual(json.loads(strava.athlete['profile']),{"id": 7654321, "firstname": "Jonathan", "lastname": "Jenkyn"})
+    buildTotals.assert_called_once_with(deferrable=False)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.aws',new_callable=AWSRegistry)
+  @patch('src.layers.strava.src.python.strava.boto3.resource')
+  def test_tablesAreSharedAcrossInstances(self,resource,aws,getAthleteFromDDB,getEnv):
+    getEnv.return_value = "Totals"
+    getAthleteFromDDB.return_value = None
+    tables = [Strava(athleteId = athleteId,stravaClientId = "1234",stravaClientSecret = "abcd")._getDDBTable() for athleteId in range(5)]
+    self.assertEqual(resource.call_count,1)
+    self.assertEqual(resource.return_value.Table.call_count,1)
+    self.assertTrue(all(table is tables[0] for table in tables))
+    with patch.dict('os.environ',{"resetWorkers": "16"}):
+      self.assertEqual(AWSRegistry().getPoolSize(),32)
+    with patch.dict('os.environ',{"awsPoolSize": "5"}):
+      self.assertEqual(AWSRegistry().getPoolSize(),5)
+    self.assertEqual(AWSRegistry().getPoolSize(),10)
+    # A handler's own pools all count, whether or not they're set in the environment
+    with patch.dict('src.layers.strava.src.python.strava.worker_defaults',{"webhookWorkers": 4, "ioWorkers": 16, "fetchWorkers": 8}):
+      self.assertEqual(AWSRegistry().getPoolSize(),56)
+      with patch.dict('os.environ',{"ioWorkers": "2"}):
+        self.assertEqual(AWSRegistry().getPoolSize(),28)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  def test_claimActivity(self,getAthleteFromDDB,getSSM,getEnv):
+    tokens={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(tokens)}
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    strava=Strava(athleteId = 1234567)
+    strava.ddbDetailTable = mock.Mock()
+    claimed = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}},"UpdateItem")
+    strava.ddbDetailTable.update_item.side_effect = [{}, claimed, claimed, {}]
+    strava.ddbDetailTable.get_item.side_effect = [{"Item": {"webhookState": "processing"}}, {"Item": {"webhookState": "done"}}]
+    self.assertEqual(strava.claimActivity(42),Strava.CLAIM_ACQUIRED)
+    # Someone else working on it is told apart from it being finished
+    self.assertEqual(strava.claimActivity(42),Strava.CLAIM_HELD)
+    self.assertEqual(strava.claimActivity(42),Strava.CLAIM_DONE)
+    args = strava.ddbDetailTable.update_item.call_args_list[0][1]
+    self.assertEqual(args['Key'],{'activityId': 42,'athleteId': 1234567})
+    self.assertIn("attribute_not_exists(webhookState)",args['ConditionExpression'])
+    # Storing the activity finishes the claim without replacing the row
+    strava.putDetailActivity({"id": 42, "type": "Run", "distance": 5000, "moving_time": 1500, "start_date": "2022-01-01T08:00:00Z"},processed=True)
+    args = strava.ddbDetailTable.update_item.call_args[1]
+    self.assertIn("REMOVE webhookLease",args['UpdateExpression'])
+    self.assertIn("done",args['ExpressionAttributeValues'].values())
+    strava.ddbDetailTable.put_item.assert_not_called()
+    strava.ddbDetailTable.update_item.side_effect = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}},"UpdateItem")
+    with self.assertRaises(ClientError):
+      strava.claimActivity(43)
+  @patch('src.layers.strava.src.python.strava.Utils.getEnv')
+  @patch('src.layers.strava.src.python.strava.Utils.getSSM')
+  @patch('src.layers.strava.src.python.strava.Strava._getAthleteFromDDB')
+  @patch('src.layers.strava.src.python.strava.Strava._getTokensWithRefresh')
+  @patch('src.layers.strava.src.python.strava.tokenManager',new_callable=TokenManager)
+  def test_tokenManagerRefreshesOnce(self,manager,getTokensWithRefresh,getAthleteFromDDB,getSSM,getEnv):
+    expired={"expires_at":1234567890,"access_token":"abcdef1234567890","refresh_token":"0987654321fedcba"}
+    fresh={"expires_at":int(time.time())+21600,"access_token":"fedcba","refresh_token":"abcdef","token_type":"Bearer"}
+    getAthleteFromDDB.return_value = {"tokens": json.dumps(expired)}
+    getTokensWithRefresh.return_value = fresh
+    getSSM.return_value = "DEADBEEF"
+    getEnv.return_value = "1234"
+    stravas=[Strava(athleteId = 1234567) for i in range(4)]
+    table = mock.Mock()
+    table.update_item.return_value = {"Attributes": {"Id": "1234567", "tokens": json.dumps(expired)}}
+    for strava in stravas:
+      strava.ddbTable = table
+    with ThreadPoolExecutor(max_workers=4) as pool:
+      list(pool.map(lambda strava: strava.refreshTokens(), stravas))
+    self.assertEqual(getTokensWithRefresh.call_count,1)
+    self.assertTrue(all(strava.tokens['access_token'] == "fedcba" for strava in stravas))
+    # The lease, then the new tokens written once with the lease released
+    self.assertEqual(table.update_item.call_count,2)
+    self.assertEqual(json.loads(table.update_item.call_args[1]['ExpressionAttributeValues'][':t'])['refresh_token'],"abcdef")
+    # Fresh tokens cost nothing
+    stravas[0].refreshTokens()
+    self.assertEqual(table.update_item.call_count,2)
+    # Someone else holding the lease while our tokens still work means we just use ours
+    manager.clear()
+    soon={"expires_at":int(time.time())+60,"access_token":"soon","refresh_token":"soon"}
+    strava = stravas[0]
+    strava.tokens = soon
+    table.update_item.side_effect = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}},"UpdateItem")
+    strava.refreshTokens()
+    self.assertEqual(strava.tokens['access_token'],"soon")
+    self.assertEqual(getTokensWithRefresh.call_count,1)
+  def test_metricsFlushAsEMF(self):
+    metrics = Metrics()
+    with metrics.span("Strava","GET activities/{id}") as span:
+      span.status = 200
+    with metrics.span("Strava","GET activities/{id}") as span:
+      span.status = 429
+      span.retries = 2
+    with self.assertRaises(ValueError):
+      with metrics.span("Twitter","update_status"):
+        raise ValueError("nope")
+    # botocore's own events time the AWS calls
+    import boto3
+    from botocore.stub import Stubber
+    ssm = metrics.instrument(boto3.client("ssm",region_name="eu-west-1",aws_access_key_id="a",aws_secret_access_key="b"))
+    with Stubber(ssm) as stubber:
+      stubber.add_response("get_parameters",{"Parameters": [],"InvalidParameters": ["x"]})
+      ssm.get_parameters(Names=["x"])
+    with mock.patch('builtins.print') as printed:
+      documents = metrics.flush("webhook")
+    self.assertEqual(printed.call_count,3)
+    byOperation = {(document['Dependency'],document['Operation']): document for document in documents}
+    strava = byOperation[("Strava","GET activities/{id}")]
+    self.assertEqual((strava['Calls'],strava['Errors'],strava['Retries']),(2,1,2))
+    self.assertEqual(strava['Statuses'],{"200": 1,"429": 1})
+    self.assertEqual(len(strava['Latency']),2)
+    self.assertEqual(strava['_aws']['CloudWatchMetrics'][0]['Dimensions'][0],["Function","Dependency","Operation"])
+    self.assertEqual(byOperation[("Twitter","update_status")]['Statuses'],{"ValueError": 1})
+    self.assertEqual(byOperation[("SSM","GetParameters")]['Calls'],1)
+    self.assertEqual(json.loads(printed.call_args_list[0][0][0])['Function'],"webhook")
+    # Flushing starts the next invocation afresh
+    self.assertEqual(metrics.flush("webhook"),[])
+    self.assertEqual(Utils.metricPath("https://www.strava.com/api/v3/activities/123?include_all_efforts=true"),"activities/{id}")
+
+  def test_payloadLogIsLazyAndBudgeted(self):
+    serialised = []
+    class Payload(object):
+      def __str__(self):
+        serialised.append(1)
+        return "x"*30
+    payloads = PayloadLog(budget=125,maxSize=50,samplePercent=0)
+    # At DEBUG by default, so with INFO logging nothing is even serialised
+    with self.assertLogs(level="INFO") as logs:
+      payloads.log("Event",{"big": Payload()})
+      logging.getLogger().info("marker")
+    self.assertEqual(len(serialised),0)
+    self.assertEqual(len(logs.output),1)
+    with self.assertLogs(level="DEBUG") as logs:
+      payloads.log("Event",{"big": Payload()})
+      payloads.log("Totals","y"*200)
+      payloads.log("Page","z"*35)
+      payloads.log("Page","z"*10)
+    self.assertEqual(len(serialised),1)
+    self.assertIn('{"big": "' + "x"*30,logs.output[0])
+    # Big payloads are cut down (none sampled here)...
+    self.assertIn("y"*50 + "... (150 more bytes)",logs.output[1])
+    # ...and once the budget is spent only sizes are logged, with one warning
+    self.assertTrue(logs.output[2].startswith("WARNING"))
+    self.assertIn("(35 bytes not logged)",logs.output[3])
+    self.assertIn("z"*10,logs.output[4])
+    self.assertEqual(payloads.skipped,1)
+    payloads.reset()
+    self.assertEqual(payloads.used,0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,214 @@
+import unittest
+import json
+import os
+import sys
+import datetime
+import threading
+import importlib.util
+
+from concurrent.futures import ThreadPoolExecutor
+
+from unittest import mock
+from unittest.mock import patch
+
+# The handler imports the layer as plain `strava`, the way Lambda lays it out
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "layers", "strava", "src", "python"))
+spec = importlib.util.spec_from_file_location("webhook_index", os.path.join(ROOT, "src", "webhook", "index.py"))
+webhook = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(webhook)
+
+YEAR = datetime.datetime.now().year
+
+def makeActivity(activityId, hour, activityType="Run", distance=5000, duration=1800):
+  return {
+    "id": activityId,
+    "type": activityType,
+    "distance": distance,
+    "moving_time": duration,
+    "elapsed_time": duration,
+    "start_date": "{}-01-02T{:02d}:00:00Z".format(YEAR, hour)
+    }
+
+def makeEvent(*records):
+  # records are (messageId, owner_id, object_id)
+  return {"Records": [{"messageId": messageId, "body": json.dumps({"aspect_type": "create", "object_type": "activity", "owner_id": ownerId, "object_id": objectId, "subscription_id": 1})} for messageId, ownerId, objectId in records]}
+
+class FakeStrava(object):
+  # Stands in for one athlete's Strava instance. Activities it doesn't know come back as {},
+  # the way _get answers when Strava won't give us one.
+  CLAIM_ACQUIRED = "acquired"
+  CLAIM_DONE = "done"
+  CLAIM_HELD = "held"
+
+  def __init__(self, activities, failTotals=False, failTokens=False):
+    self.athlete = {"Id": "1"}
+    self.activities = {activity['id']: activity for activity in activities}
+    self.failTotals = failTotals
+    self.failTokens = failTokens
+    self.lock = threading.Lock()
+    self.claimed = set()
+    self.done = set()
+    self.counted = set()
+    self.released = []
+    self.added = []
+    self.stored = []
+    self.fetched = []
+
+  def refreshTokens(self):
+    if self.failTokens:
+      raise ConnectionError("Couldn't refresh tokens")
+
+  def claimActivity(self, activityId):
+    with self.lock:
+      if activityId in self.done:
+        return self.CLAIM_DONE
+      if activityId in self.claimed:
+        return self.CLAIM_HELD
+      self.claimed.add(activityId)
+      return self.CLAIM_ACQUIRED
+
+  def releaseActivity(self, activityId):
+    with self.lock:
+      self.claimed.discard(activityId)
+      self.released.append(activityId)
+
+  def getActivity(self, activityId, notBefore=None):
+    with self.lock:
+      self.fetched.append(activityId)
+    return dict(self.activities.get(activityId, {}))
+
+  def countActivities(self, activities, activityId=None):
+    if self.failTotals:
+      raise ConnectionError("DynamoDB is having a bad day")
+    activities = [activity for activity in activities if activity[0] is None or activity[0] not in self.counted]
+    ids = [activity[0] for activity in activities if activity[0] is not None]
+    self.counted.update(ids)
+    if len(activities) > 0:
+      self.added.append(([activity[1:] for activity in activities], activityId))
+    totals = {}
+    for added, lastId in self.added:
+      for activityType, distance, duration in added:
+        fields = totals.setdefault(activityType, {"distance": 0, "duration": 0, "count": 0})
+        fields['distance'] += int(distance)
+        fields['duration'] += int(duration)
+        fields['count'] += 1
+    return {str(YEAR): totals}, ids
+
+  def putDetailActivity(self, activity, processed=False):
+    with self.lock:
+      self.stored.append(activity['id'])
+      if processed:
+        self.claimed.discard(activity['id'])
+        self.done.add(activity['id'])
+
+  def makeTwitterString(self, athlete_year_stats, latest_event):
+    return "{ID} is run {COUNT}".format(ID=latest_event['id'], COUNT=athlete_year_stats[latest_event['type']]['count'])
+
+  def updateActivityDescription(self, athlete_year_stats, latest_event, spotifytracks=None):
+    return True
+
+class TestWebhook(unittest.TestCase):
+  def run_handler(self, event, athletes):
+    twitter = mock.Mock()
+    with patch.object(webhook, 'Strava', side_effect=lambda athleteId: athletes[athleteId]), \
+         patch.object(webhook, 'getTwitterClient', return_value=twitter) as getTwitterClient, \
+         patch.object(webhook.Utils, 'getSSM', return_value=None), \
+         patch.object(webhook.Utils, 'flushMetrics'), \
+         patch.dict(os.environ, {"ssmPrefix": "test"}):
+      response = webhook.lambda_handler(event, None)
+    self.twitterClients = getTwitterClient.call_count
+    statuses = [call.kwargs['status'] for call in twitter.update_status.call_args_list]
+    return sorted(failure['itemIdentifier'] for failure in response['batchItemFailures']), statuses
+
+  def test_mixedBatchOnlyFailsTheMissingActivity(self):
+    # 202 has been deleted on Strava; the other two still go through, in start order
+    strava = FakeStrava([makeActivity(201, 9), makeActivity(203, 8)])
+    failures, statuses = self.run_handler(makeEvent(("m0", 2, 201), ("m1", 2, 202), ("m2", 2, 203)), {2: strava})
+    self.assertEqual(failures, ["m1"])
+    self.assertEqual(statuses, ["203 is run 1", "201 is run 2"])
+    self.assertEqual(strava.released, [202])
+    self.assertEqual(len(strava.added), 1)
+    self.assertEqual(strava.added[0][1], 201)
+    self.assertEqual(sorted(strava.stored), [201, 203])
+
+  def test_partialFailureOnlyReportsThatAthlete(self):
+    # Athlete 2's tokens can't be refreshed; athlete 1 carries on regardless
+    one = FakeStrava([makeActivity(101, 8), makeActivity(102, 9)])
+    two = FakeStrava([makeActivity(201, 8)], failTokens=True)
+    failures, statuses = self.run_handler(makeEvent(("m0", 1, 101), ("m1", 2, 201), ("m2", 1, 102)), {1: one, 2: two})
+    self.assertEqual(failures, ["m1"])
+    self.assertEqual(statuses, ["101 is run 1", "102 is run 2"])
+    self.assertEqual(two.fetched, [])
+
+  def test_wholeBatchFailsWhenTotalsCantBeWritten(self):
+    strava = FakeStrava([makeActivity(101, 8), makeActivity(102, 9)], failTotals=True)
+    failures, statuses = self.run_handler(makeEvent(("m0", 1, 101), ("m1", 1, 102)), {1: strava})
+    self.assertEqual(failures, ["m0", "m1"])
+    self.assertEqual(statuses, [])
+    # Nothing was counted, so the retry must be able to claim them again
+    self.assertEqual(sorted(strava.released), [101, 102])
+    self.assertEqual(strava.claimed, set())
+    self.assertEqual(strava.stored, [])
+
+  def test_duplicateRecordsAreProcessedOnce(self):
+    strava = FakeStrava([makeActivity(101, 8), makeActivity(102, 9)])
+    strava.athlete['last_activity_id'] = 102
+    event = makeEvent(("m0", 1, 101), ("m1", 1, 101), ("m2", 1, 102))
+    # An unreadable message is let go rather than retried
+    event['Records'].append({"messageId": "m3", "body": "not json"})
+    failures, statuses = self.run_handler(event, {1: strava})
+    self.assertEqual(failures, [])
+    self.assertEqual(statuses, ["101 is run 1"])
+    self.assertEqual(strava.fetched, [101])
+    # A redelivery in a later batch finds it done
+    failures, statuses = self.run_handler(makeEvent(("m4", 1, 101)), {1: strava})
+    self.assertEqual((failures, statuses), ([], []))
+    self.assertEqual(len(strava.added), 1)
+    # With nothing to tweet, no Twitter client is made
+    self.assertEqual(self.twitterClients, 0)
+
+  def test_heldClaimIsRetried(self):
+    # Another delivery holds 101 (or held it and died); 102 carries on regardless
+    strava = FakeStrava([makeActivity(101, 8), makeActivity(102, 9)])
+    strava.claimed.add(101)
+    failures, statuses = self.run_handler(makeEvent(("m0", 1, 101), ("m1", 1, 102)), {1: strava})
+    self.assertEqual(failures, ["m0"])
+    self.assertEqual(statuses, ["102 is run 1"])
+    # Once the lease has run out the retry gets it
+    strava.claimed.discard(101)
+    failures, statuses = self.run_handler(makeEvent(("m0", 1, 101)), {1: strava})
+    self.assertEqual((failures, statuses), ([], ["101 is run 2"]))
+
+  def test_retryDoesNotCountTwice(self):
+    # An earlier delivery counted 101 and then died before finishing it
+    strava = FakeStrava([makeActivity(101, 8), makeActivity(102, 9)])
+    strava.countActivities([(101, "Run", 5000, 1800)])
+    failures, statuses = self.run_handler(makeEvent(("m0", 1, 101), ("m1", 1, 102)), {1: strava})
+    self.assertEqual(failures, [])
+    # 101 isn't tweeted again, but is stored and done
+    self.assertEqual(statuses, ["102 is run 2"])
+    self.assertEqual(strava.added[-1], ([("Run", 5000, 1800)], 102))
+    self.assertEqual(sorted(strava.done), [101, 102])
+
+  def test_claimsDontQueueBehindChains(self):
+    # Every chain thread is tied up waiting; the claim and fetch still go ahead
+    strava = FakeStrava([makeActivity(101, 8)])
+    busy = ThreadPoolExecutor(max_workers=1)
+    blocker = threading.Event()
+    busy.submit(blocker.wait)
+    seen = []
+    def release():
+      seen.extend(strava.fetched)
+      blocker.set()
+    timer = threading.Timer(0.5, release)
+    timer.start()
+    with patch.dict(webhook.pools, {"ioWorkers": busy}):
+      failures, statuses = self.run_handler(makeEvent(("m0", 1, 101)), {1: strava})
+    timer.join()
+    busy.shutdown()
+    self.assertEqual(seen, [101])
+    self.assertEqual((failures, statuses), ([], ["101 is run 1"]))
+
+if __name__ == '__main__':
+  unittest.main()